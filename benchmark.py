@@ -0,0 +1,449 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+from PIL import Image
+from pydub import AudioSegment
+from pydub.generators import Sine, WhiteNoise
+
+import dirs
+from library.files import XLSXFile, YAMLFile
+from library.process import run_as_process
+from library.report import peak_rss_mb
+
+
+# =================== #
+# Синтетические входы #
+# =================== #
+
+def make_audio(path: Path, duration: int, frequency: float) -> Path:
+    """ Тон с шумом заданной длительности (в секундах), в m4a, как скачанные треки """
+    tone = Sine(frequency).to_audio_segment(duration=duration * 1000, volume=-12)
+    noise = WhiteNoise().to_audio_segment(duration=duration * 1000, volume=-36)
+    segment = tone.overlay(noise).set_channels(2).set_frame_rate(44100)
+    segment.export(str(path), format="mp4", codec="aac")
+    return path
+
+
+def make_image(path: Path, size: tuple, rng: np.random.Generator) -> Path:
+    """ Плавные цветные пятна с зерном (шум без пятен сжимается нетипично плохо) """
+    w, h = size
+    blobs = Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)).resize((w, h), Image.BICUBIC)
+    grain = rng.integers(-8, 9, (h, w, 3))
+    pixels = np.clip(np.asarray(blobs, dtype=np.int16) + grain, 0, 255).astype(np.uint8)
+    Image.fromarray(pixels).save(str(path), format="JPEG", quality=90)
+    return path
+
+
+def make_inputs(work_dir: Path, styles: dict, tracks: int, duration: int, seed: int) -> dict:
+    """ Треки, картинки и плейлист для замеров (одинаковые при одинаковом seed) """
+
+    rng = np.random.default_rng(seed)
+    fetch_dir = work_dir / "tracks"
+    fetch_dir.mkdir()
+
+    rows = []
+    for idx in range(tracks):
+        song_id = f"bench{idx:03d}"
+        make_audio(fetch_dir / f"{song_id}.m4a", duration, frequency=float(rng.uniform(220, 880)))
+        rows.append(OrderedDict([
+            ("url", f"https://youtube.com/watch?v={song_id}"),
+            ("title", f"Benchmark track {idx + 1}"),
+            ("crop_start", 0),
+            ("crop_end", 0)
+        ]))
+
+    xlsx_file = work_dir / "playlist.xlsx"
+    XLSXFile(xlsx_file).write(rows)
+
+    size = styles["v2"]["image"]["size"]
+    return {
+        "styles": styles,
+        "fetch_dir": fetch_dir,
+        "xlsx_file": xlsx_file,
+        "songs": [dict(row) for row in rows],
+        "audio": fetch_dir / "bench000.m4a",
+        "bg_file": make_image(work_dir / "bg.jpg", (styles["width"], styles["height"]), rng),
+        "img_file": make_image(work_dir / "img.jpg", (size, size), rng),
+        "duration": duration
+    }
+
+
+# ====== #
+# Замеры #
+# ====== #
+
+def cpu_time() -> float:
+    """ Процессорное время процесса и завершившихся дочерних процессов (ffmpeg, пул) """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def measure(func: Callable[[], Optional[dict]]) -> dict:
+    """ Выполнить func, замерив время; func может вернуть дополнительные сведения """
+    start_wall = time.perf_counter()
+    start_cpu = cpu_time()
+    extra = func() or {}
+    return {
+        "wall": time.perf_counter() - start_wall,
+        "cpu": cpu_time() - start_cpu,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_children_mb": peak_rss_mb(children=True),
+        **extra
+    }
+
+
+def bench_frame_render_v1(inputs: dict, fps: Optional[int] = None) -> dict:
+    from playlist_v1 import FrameRenderer, get_fps, get_main_rect
+
+    styles = inputs["styles"]
+    duration = inputs["duration"]
+    fps = fps or get_fps(styles)
+    bg_image = Image.open(inputs["bg_file"])
+    renderer = FrameRenderer(styles, bg_image, get_main_rect(styles), duration, fps=fps)
+
+    def run():
+        frames = (duration + 2) * fps
+        for frame in range(frames):
+            renderer.get_frame(frame)
+        return {"frames": frames, "fps": fps}
+
+    return measure(run)
+
+
+def bench_frame_render_v1_30fps(inputs: dict) -> dict:
+    """ Плавная полоска: время должно расти с числом изменений, а не кадров """
+    return bench_frame_render_v1(inputs, fps=30)
+
+
+def bench_frame_render_v2(inputs: dict) -> dict:
+    from playlist_v2 import get_frame
+
+    styles = inputs["styles"]
+    bg_image = Image.open(inputs["bg_file"])
+    titles = [song["title"] for song in inputs["songs"]]
+    tracklist_coords = (styles["v2"]["tracklist"]["x"], styles["v2"]["tracklist"]["y"])
+
+    def run():
+        for title in titles:
+            get_frame(styles, bg_image, tracklist_coords, titles=titles, current_title=title)
+        return {"frames": len(titles)}
+
+    return measure(run)
+
+
+def bench_blur(inputs: dict) -> dict:
+    from PIL import ImageFilter
+    from library.blur import blur_region
+    from playlist_v1 import get_main_rect
+
+    radius = inputs["styles"]["v1"]["blur_radius"]
+    rect = get_main_rect(inputs["styles"])
+    bg_image = Image.open(inputs["bg_file"]).convert("RGB")
+    blurred = {}
+
+    def run():
+        blurred["image"] = blur_region(bg_image, rect, radius)
+
+    result = measure(run)
+
+    # Отличие от размытия всей картинки и кадрирования (0-255 на канал)
+    start = time.perf_counter()
+    reference = bg_image.filter(ImageFilter.GaussianBlur(radius=radius)).crop(rect)
+    reference_wall = time.perf_counter() - start
+    diff = np.abs(np.asarray(blurred["image"], dtype=np.int16) - np.asarray(reference, dtype=np.int16))
+
+    return {**result, "reference_wall": reference_wall, "max_error": int(diff.max()), "mean_error": float(diff.mean())}
+
+
+def bench_audio_assembly(inputs: dict) -> dict:
+    from library.audio import AudioAssembler
+
+    tracks = sorted(inputs["fetch_dir"].iterdir())
+
+    def run():
+        silence = AudioSegment.from_mp3(str(dirs.static / "silence22.mp3"))[:2200]
+        with AudioAssembler(dirs.cache / "playlist.mp3") as audio:
+            for path in tracks:
+                audio.append(AudioSegment.from_file(str(path)), crossfade=100)
+                audio.append(silence, crossfade=100)
+        return {"tracks": len(tracks)}
+
+    return measure(run)
+
+
+def bench_encode_v1(inputs: dict, fps: Optional[int] = None) -> dict:
+    from library.fetch import LocalFetcher
+    from playlist_v1 import visualize_song
+
+    song = inputs["songs"][0]
+    fetcher = LocalFetcher(inputs["fetch_dir"])
+    styles = inputs["styles"]
+    if fps:
+        styles = {**styles, "v1": {**styles["v1"], "fps": fps}}
+
+    def run():
+        visualize_song(
+            styles=styles,
+            url=song["url"],
+            title=song["title"],
+            bg_file=inputs["bg_file"],
+            save_dir=dirs.cache,
+            silent=True,
+            fetcher=fetcher
+        )
+        return {"seconds": inputs["duration"] + 2}
+
+    return measure(run)
+
+
+def bench_encode_v1_30fps(inputs: dict) -> dict:
+    """ Сборка с плавной полоской: время должно быть небольшим кратным времени при 1 fps """
+    return bench_encode_v1(inputs, fps=30)
+
+
+def bench_encode_v1_chunked(inputs: dict) -> dict:
+    from concurrent.futures import ProcessPoolExecutor
+    from library.fetch import LocalFetcher
+    from library.process import default_workers
+    from playlist_v1 import visualize_song
+
+    song = inputs["songs"][0]
+    fetcher = LocalFetcher(inputs["fetch_dir"])
+    workers = default_workers()
+
+    def run():
+        # Трек делится на части по числу ядер
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            visualize_song(
+                styles=inputs["styles"],
+                url=song["url"],
+                title=song["title"],
+                bg_file=inputs["bg_file"],
+                save_dir=dirs.cache,
+                silent=True,
+                fetcher=fetcher,
+                executor=executor,
+                chunk_seconds=max(1, (inputs["duration"] + 2) // workers)
+            )
+        return {"seconds": inputs["duration"] + 2, "workers": workers}
+
+    return measure(run)
+
+
+def bench_encode_still(inputs: dict) -> dict:
+    from library.ffmpeg import encode_still
+
+    png = dirs.cache / "still.png"
+    Image.open(inputs["bg_file"]).save(str(png), format="PNG")
+
+    def run():
+        encode_still(png, dirs.cache / "still.mp4", duration=inputs["duration"] + 2)
+        return {"seconds": inputs["duration"] + 2}
+
+    return measure(run)
+
+
+def bench_concat(inputs: dict) -> dict:
+    from library.ffmpeg import concat_videos, encode_still
+
+    png = dirs.cache / "still.png"
+    Image.open(inputs["bg_file"]).save(str(png), format="PNG")
+    segment = encode_still(png, dirs.cache / "still.mp4", duration=inputs["duration"] + 2)
+    segments = [segment] * len(inputs["songs"])
+
+    def run():
+        concat_videos(segments, dirs.cache / "concat.mp4", audio=inputs["audio"])
+        return {"segments": len(segments)}
+
+    return measure(run)
+
+
+def bench_playlist_v1(inputs: dict) -> dict:
+    from library.fetch import LocalFetcher
+    from playlist_v1 import visualize_playlist
+
+    save_dir = dirs.cache / "out"
+    save_dir.mkdir()
+
+    def run():
+        visualize_playlist(
+            styles=inputs["styles"],
+            xlsx_file=inputs["xlsx_file"],
+            bg_file=inputs["bg_file"],
+            save_dir=save_dir,
+            fetcher=LocalFetcher(inputs["fetch_dir"])
+        )
+        return {"tracks": len(inputs["songs"])}
+
+    return measure(run)
+
+
+def bench_playlist_v2(inputs: dict) -> dict:
+    from library.fetch import LocalFetcher
+    from playlist_v2 import visualize_playlist
+
+    save_dir = dirs.cache / "out"
+    save_dir.mkdir()
+
+    def run():
+        visualize_playlist(
+            styles=inputs["styles"],
+            xlsx_file=inputs["xlsx_file"],
+            img_file=inputs["img_file"],
+            bg_file=inputs["bg_file"],
+            save_dir=save_dir,
+            fetcher=LocalFetcher(inputs["fetch_dir"])
+        )
+        return {"tracks": len(inputs["songs"])}
+
+    return measure(run)
+
+
+def bench_song(inputs: dict) -> dict:
+    from song import visualize_song
+
+    save_dir = dirs.cache / "out"
+    save_dir.mkdir()
+
+    def run():
+        visualize_song(
+            styles=inputs["styles"],
+            mp3_file=inputs["audio"],
+            img_file=inputs["img_file"],
+            save_dir=save_dir
+        )
+        return {"seconds": inputs["duration"]}
+
+    return measure(run)
+
+
+# Отдельные этапы и сборки целиком
+CASES = {
+    "frame_render_v1": bench_frame_render_v1,
+    "frame_render_v1_30fps": bench_frame_render_v1_30fps,
+    "frame_render_v2": bench_frame_render_v2,
+    "blur": bench_blur,
+    "audio_assembly": bench_audio_assembly,
+    "encode_v1": bench_encode_v1,
+    "encode_v1_30fps": bench_encode_v1_30fps,
+    "encode_v1_chunked": bench_encode_v1_chunked,
+    "encode_still": bench_encode_still,
+    "concat": bench_concat,
+    "playlist_v1": bench_playlist_v1,
+    "playlist_v2": bench_playlist_v2,
+    "song": bench_song
+}
+
+
+def run_case(name: str, inputs: dict, cache_dir: Path) -> dict:
+    """ Выполнить замер с пустым кэшем (в отдельном процессе, чтобы пиковая память была своя) """
+
+    # Переменная окружения нужна процессам, которые запустит сам замер
+    os.environ["CACHE_DIR"] = str(cache_dir)
+    dirs.cache = cache_dir
+    cache_dir.mkdir(parents=True)
+    return CASES[name](inputs)
+
+
+# ========== #
+# Результаты #
+# ========== #
+
+def get_commit() -> Optional[str]:
+    try:
+        process = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    except OSError:
+        return None
+    return process.stdout.strip() or None
+
+
+def print_results(results: dict, baseline: Optional[dict] = None) -> None:
+    """ Вывести время замеров (и отношение к прошлому прогону, если он задан) """
+
+    for name, result in results.items():
+        line = f"{name:16} {result['wall']:9.2f} s wall {result['cpu']:9.2f} s cpu"
+        if result["peak_rss_mb"] is not None:
+            line += f" {result['peak_rss_mb']:8.0f} MB"
+        old = (baseline or {}).get(name)
+        if old:
+            line += f"   x{result['wall'] / old['wall']:.2f} vs {old['wall']:.2f} s"
+        print(line)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic playlists")
+    parser.add_argument("cases", nargs="*", help=f"cases to run: {', '.join(CASES)} (default: all)")
+    parser.add_argument("--tracks", type=int, default=5, help="number of tracks in the playlist")
+    parser.add_argument("--duration", type=int, default=30, help="track duration in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic inputs")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case (the fastest is reported)")
+    parser.add_argument("--styles", type=Path, default=Path("styles.yml"), help="styles file")
+    parser.add_argument("--output", type=Path, help="results file (default: benchmark_<commit>.json)")
+    parser.add_argument("--compare", type=Path, help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    cases = args.cases or list(CASES)
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+    styles = YAMLFile(args.styles).read()
+    commit = get_commit()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="benchmark_"))
+    try:
+        inputs = make_inputs(work_dir, styles, args.tracks, args.duration, args.seed)
+
+        results = {}
+        for name in cases:
+            runs = []
+            for number in range(args.repeat):
+                cache_dir = work_dir / "cache" / f"{name}_{number}"
+                runs.append(run_as_process(run_case, name, inputs, cache_dir))
+            best = min(runs, key=lambda run: run["wall"])
+            results[name] = {**best, "runs": runs}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "tracks": args.tracks,
+            "duration": args.duration,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "styles": str(args.styles)
+        },
+        "results": results
+    }
+
+    output = args.output or Path(f"benchmark_{commit or 'local'}.json")
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2, default=str)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+
+    print_results(results, baseline)
+    print(f"Saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import argparse
+from pathlib import Path
+
+import dirs
+from library.cache import get_index
+from library.files import YAMLFile
+
+
+def get_budget(config: dict) -> dict:
+    """ Бюджет кэша из конфига (0 или отсутствие ключа - без ограничения) """
+
+    max_size_mb = config.get("cache_max_size_mb") or 0
+    max_age_days = config.get("cache_max_age_days") or 0
+
+    return {
+        "max_bytes": int(max_size_mb * 1024 * 1024) if max_size_mb else None,
+        "max_age": max_age_days * 24 * 60 * 60 if max_age_days else None
+    }
+
+
+def prune_cache(config: dict) -> list[str]:
+    """ Удалить давно не использованные файлы кэша сверх бюджета """
+
+    budget = get_budget(config)
+    if budget["max_bytes"] is None and budget["max_age"] is None:
+        return []
+    return get_index(dirs.cache).prune(**budget)
+
+
+def print_report(top: int) -> None:
+    """ Вывести статистику кэша и самые большие файлы """
+
+    index = get_index(dirs.cache)
+    stats = index.stats()
+
+    print(f"Files: {stats['count']}")
+    print(f"Size: {stats['size'] / 1024 / 1024:.1f} MB")
+    print(f"Hit rate: {stats['hit_rate']:.1%} ({stats['hits']} hits, {stats['misses']} misses)")
+    print("Largest files:")
+    for name, size in index.largest(top):
+        print(f"  {size / 1024 / 1024:10.1f} MB  {name}")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Cache statistics and cleanup")
+    parser.add_argument("--prune", action="store_true", help="remove files over the cache budget")
+    parser.add_argument("--max-size-mb", type=float, help="size budget (default: cache_max_size_mb from config.yml)")
+    parser.add_argument("--max-age-days", type=float, help="age budget (default: cache_max_age_days from config.yml)")
+    parser.add_argument("--top", type=int, default=10, help="number of largest files to show")
+    args = parser.parse_args()
+
+    config_file = Path("config.yml")
+    config = YAMLFile(config_file).read() if config_file.exists() else {}
+
+    if args.prune:
+        if args.max_size_mb is not None:
+            config["cache_max_size_mb"] = args.max_size_mb
+        if args.max_age_days is not None:
+            config["cache_max_age_days"] = args.max_age_days
+        removed = prune_cache(config)
+        print(f"Removed {len(removed)} files")
+
+    print_report(args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Iterator, Optional
+
+from loguru import logger
+
+from library.cache import file_lock
+from library.files import YAMLFile
+from library.process import default_workers, start_executor, warm_up
+from main import run_job
+
+
+# Ключи config.yml с путями: при постановке в очередь они делаются абсолютными,
+# потому что демон может работать в другой папке
+PATH_KEYS = ("xlsx_file", "bg_file", "img_file", "mp3_file", "styles_file", "save_dir", "fetch_dir")
+
+
+class Spool:
+    """ Очередь заданий в папке
+
+    queue - задания (config.yml), которые ждут, running - выполняются,
+    status - состояние каждого задания в json. Задание забирается переносом
+    файла, поэтому его не возьмут два демона сразу.
+
+    В имени выполняемого задания записан демон, который его забрал (owner:
+    компьютер и номер процесса). Пока демон работает, он держит блокировку
+    owners/<owner>.lock: по ней другие демоны узнают, жив ли он.
+    """
+
+    def __init__(self, root: Path, owner: Optional[str] = None):
+        self.root = root
+        self.queue = root / "queue"
+        self.running = root / "running"
+        self.status = root / "status"
+        self.owners = root / "owners"
+        for folder in (self.queue, self.running, self.status, self.owners):
+            folder.mkdir(parents=True, exist_ok=True)
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+
+    def submit(self, config: dict) -> str:
+        """ Поставить задание в очередь и вернуть его номер """
+
+        job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.set_status(job_id, state="queued", submitted=time.time())
+
+        # Задание появляется в очереди целиком: сначала пишется временный файл
+        tmp_path = self.queue / f"{job_id}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(config, file, ensure_ascii=False)
+        tmp_path.replace(self.queue / f"{job_id}.job")
+
+        return job_id
+
+    def get_status(self, job_id: str) -> Optional[dict]:
+        path = self.status / f"{job_id}.json"
+        if not path.exists():
+            return None
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def set_status(self, job_id: str, **fields) -> dict:
+        status = {**(self.get_status(job_id) or {"id": job_id}), **fields}
+        tmp_path = self.status / f"{job_id}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(status, file, indent=2, ensure_ascii=False, default=str)
+        tmp_path.replace(self.status / f"{job_id}.json")
+        return status
+
+    @contextmanager
+    def serving(self) -> Iterator[None]:
+        """ Отмечать демон живым, пока он выполняет задания из очереди """
+        lock_path = self.owners / f"{self.owner}.lock"
+        with file_lock(lock_path):
+            yield
+        lock_path.unlink(missing_ok=True)
+
+    def is_alive(self, owner: str) -> bool:
+        """ Работает ли демон owner (его блокировку нельзя взять) """
+        lock_path = self.owners / f"{owner}.lock"
+        with file_lock(lock_path, wait=False) as acquired:
+            if not acquired:
+                return True
+        lock_path.unlink(missing_ok=True)
+        return False
+
+    def get_running_path(self, job_id: str) -> Path:
+        return self.running / f"{job_id}.{self.owner}.job"
+
+    def take(self) -> Optional[str]:
+        """ Забрать самое старое задание из очереди (None, если очередь пуста) """
+        for path in sorted(self.queue.glob("*.job")):
+            try:
+                path.replace(self.get_running_path(path.stem))
+            except FileNotFoundError:
+                # Задание успел забрать другой демон
+                continue
+            return path.stem
+        return None
+
+    def read(self, job_id: str) -> dict:
+        with open(self.get_running_path(job_id), "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def finish(self, job_id: str) -> None:
+        self.get_running_path(job_id).unlink(missing_ok=True)
+
+    def recover(self) -> list[str]:
+        """ Вернуть в очередь задания демонов, которые остановились, не закончив их
+
+        Задания работающих демонов (в том числе на других компьютерах) не трогаются.
+        """
+        job_ids = []
+        for path in self.running.glob("*.job"):
+            # Номер задания без точек, дальше до .job - владелец
+            job_id, _, owner = path.name[:-len(".job")].partition(".")
+            if owner and self.is_alive(owner):
+                continue
+            try:
+                path.replace(self.queue / f"{job_id}.job")
+            except FileNotFoundError:
+                # Задание успел вернуть другой демон
+                continue
+            self.set_status(job_id, state="queued")
+            job_ids.append(job_id)
+        return job_ids
+
+
+def is_broken(executor: ProcessPoolExecutor) -> bool:
+    try:
+        executor.submit(warm_up, 0).result()
+    except BrokenProcessPool:
+        return True
+    return False
+
+
+def run(spool: Spool, job_id: str, executor: ProcessPoolExecutor) -> dict:
+    """ Выполнить задание из очереди, записывая его состояние """
+
+    started = time.time()
+    submitted = (spool.get_status(job_id) or {}).get("submitted") or started
+    spool.set_status(job_id, state="running", owner=spool.owner, started=started, queue_latency=started - submitted)
+    logger.info(f"Job {job_id} started")
+
+    try:
+        result = run_job(spool.read(job_id), executor=executor)
+    except Exception:
+        logger.exception(f"Job {job_id} failed")
+        status = spool.set_status(
+            job_id,
+            state="failed",
+            finished=time.time(),
+            duration=time.time() - started,
+            error=traceback.format_exc()
+        )
+    else:
+        status = spool.set_status(
+            job_id,
+            state="done",
+            finished=time.time(),
+            duration=time.time() - started,
+            result=result
+        )
+        logger.info(f"Job {job_id} done in {status['duration']:.1f} s")
+    finally:
+        spool.finish(job_id)
+
+    return status
+
+
+def serve(spool: Spool, workers: int, poll: float) -> None:
+    """ Выполнять задания из очереди по одному, пока демон не остановят
+
+    Модули, шрифты, общие фоны v1 и процессы пула остаются загруженными
+    между заданиями, поэтому задание начинается без затрат на запуск.
+    """
+
+    executor = start_executor(workers)
+    try:
+        with spool.serving():
+            for job_id in spool.recover():
+                logger.info(f"Job {job_id} requeued")
+            logger.info(f"Serving {spool.root} as {spool.owner} with {workers} workers")
+
+            while True:
+                job_id = spool.take()
+                if job_id is None:
+                    time.sleep(poll)
+                    continue
+                status = run(spool, job_id, executor)
+                if status["state"] == "failed" and is_broken(executor):
+                    # Процесс пула упал (например, не хватило памяти) - пул создаётся заново
+                    logger.error("Process pool is broken, restarting it")
+                    executor.shutdown(cancel_futures=True)
+                    executor = start_executor(workers)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Render daemon with a job queue in a spool folder")
+    parser.add_argument("--spool", type=Path, default=Path("spool"), help="spool folder (default: spool)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="run jobs from the queue")
+    serve_parser.add_argument("--workers", type=int, help="render processes (default: number of cores)")
+    serve_parser.add_argument("--poll", type=float, default=0.05, help="queue polling interval in seconds")
+
+    submit_parser = commands.add_parser("submit", help="add a job (a config.yml file) to the queue")
+    submit_parser.add_argument("config", type=Path, help="job config")
+    submit_parser.add_argument("--wait", action="store_true", help="wait until the job is finished")
+
+    status_parser = commands.add_parser("status", help="show job status")
+    status_parser.add_argument("job_id", nargs="?", help="job (default: all jobs)")
+
+    args = parser.parse_args()
+    spool = Spool(args.spool)
+
+    if args.command == "serve":
+        serve(spool, args.workers or default_workers(), args.poll)
+
+    elif args.command == "submit":
+        config = YAMLFile(args.config).read()
+        for key in PATH_KEYS:
+            if config.get(key):
+                config[key] = str(Path(config[key]).resolve())
+        job_id = spool.submit(config)
+        print(job_id)
+        if args.wait:
+            while spool.get_status(job_id)["state"] in ("queued", "running"):
+                time.sleep(0.1)
+            print(json.dumps(spool.get_status(job_id), indent=2, ensure_ascii=False))
+
+    elif args.command == "status":
+        job_ids = [args.job_id] if args.job_id else sorted(path.stem for path in spool.status.glob("*.json"))
+        for job_id in job_ids:
+            status = spool.get_status(job_id)
+            if status is None:
+                print(f"{job_id}  unknown")
+                continue
+            line = f"{job_id}  {status['state']}"
+            if "duration" in status:
+                line += f"  {status['duration']:.1f} s"
+            print(line)
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -1,8 +1,11 @@
+import os
 from pathlib import Path
 
 
 static = Path.cwd() / "static"
 fonts = Path.cwd() / "fonts"
-cache = Path.cwd() / "cache"
 
-cache.mkdir(exist_ok=True)
+# Папку кэша можно переопределить (например, чтобы замеры не трогали рабочий кэш)
+cache = Path(os.environ.get("CACHE_DIR") or Path.cwd() / "cache")
+
+cache.mkdir(parents=True, exist_ok=True)
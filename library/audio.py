@@ -0,0 +1,130 @@
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+from pydub import AudioSegment
+
+
+class AudioAssembler:
+    """ Склейка треков с кроссфейдом и потоковой записью результата
+
+    Повторяет цепочку AudioSegment.append(..., crossfade=...), но не копирует
+    накопленный микс на каждом шаге и не держит его в памяти: готовые данные
+    сразу уходят в ffmpeg, в памяти остаётся только последний добавленный трек.
+
+    В отличие от append, формат звука (frame_rate, channels, sample_width) задаётся
+    заранее, а не берётся самый высокий из всех треков: запись начинается, когда
+    следующие треки ещё неизвестны. Каждый трек приводится к этому формату.
+    """
+
+    def __init__(
+            self,
+            path: Path,
+            format: str = "mp3",
+            bitrate: Optional[str] = None,
+            frame_rate: int = 48000,
+            channels: int = 2,
+            sample_width: int = 2
+    ):
+        self._path = path
+        self._format = format
+        self._bitrate = bitrate
+        self._frame_rate = frame_rate
+        self._channels = channels
+        self._sample_width = sample_width
+        self._process: Optional[subprocess.Popen] = None
+        self._pending: Optional[AudioSegment] = None
+        self._written_ms = 0
+        self._closed = False
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def duration_seconds(self) -> float:
+        pending_ms = len(self._pending) if self._pending is not None else 0
+        return (self._written_ms + pending_ms) / 1000
+
+    def __enter__(self) -> "AudioAssembler":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            if not self._closed:
+                self.close()
+        else:
+            self.abort()
+
+    def _start(self) -> None:
+        sample_format = "u8" if self._sample_width == 1 else f"s{8 * self._sample_width}le"
+        self._process = subprocess.Popen(
+            [
+                AudioSegment.converter, "-y", "-loglevel", "error",
+                "-f", sample_format, "-ar", str(self._frame_rate), "-ac", str(self._channels),
+                "-i", "pipe:0",
+                *(["-b:a", str(self._bitrate)] if self._bitrate else []),
+                "-f", self._format, str(self._path)
+            ],
+            stdin=subprocess.PIPE
+        )
+
+    def _convert(self, segment: AudioSegment) -> AudioSegment:
+        return (
+            segment
+            .set_frame_rate(self._frame_rate)
+            .set_channels(self._channels)
+            .set_sample_width(self._sample_width)
+        )
+
+    def _write(self, segment: AudioSegment) -> None:
+        self._process.stdin.write(segment.raw_data)
+        self._written_ms += len(segment)
+
+    def append(self, segment: AudioSegment, crossfade: int = 100) -> None:
+        """ Добавить трек (как AudioSegment.append с тем же кроссфейдом) """
+
+        segment = self._convert(segment)
+
+        if self._process is None:
+            self._start()
+            self._pending = segment
+            return
+
+        if not crossfade:
+            self._write(self._pending)
+            self._pending = segment
+            return
+
+        if crossfade > len(self._pending):
+            raise ValueError(f"Crossfade is longer than the previous segment ({crossfade} ms)")
+        if crossfade > len(segment):
+            raise ValueError(f"Crossfade is longer than the appended segment ({crossfade} ms)")
+
+        xf = self._pending[-crossfade:].fade(to_gain=-120, start=0, end=float("inf"))
+        xf *= segment[:crossfade].fade(from_gain=-120, start=0, end=float("inf"))
+
+        self._write(self._pending[:-crossfade])
+        self._write(xf)
+        self._pending = segment[crossfade:]
+
+    def abort(self) -> None:
+        """ Прервать кодирование и удалить недописанный файл """
+        if self._process is not None and not self._closed:
+            self._process.kill()
+            self._process.wait()
+            self._closed = True
+            self._path.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        """ Дописать остаток и дождаться кодирования """
+
+        if self._process is None:
+            raise ValueError("Nothing to export: no segments were appended")
+
+        self._write(self._pending)
+        self._pending = None
+        self._process.stdin.close()
+        self._closed = True
+        if self._process.wait() != 0:
+            raise Exception(f"ffmpeg failed to encode {self._path}")
@@ -0,0 +1,39 @@
+from PIL import Image, ImageFilter
+
+
+# Радиус, начиная с которого размытие считается на уменьшенной копии:
+# после широкого размытия не остаётся мелких деталей, которые потерялись бы
+SCALED_BLUR_RADIUS = 8
+
+
+def get_blur_margin(radius: float) -> int:
+    """ На сколько пикселей размытие берёт данные из-за края области (с запасом) """
+    return int(4 * radius) + 2
+
+
+def gaussian_blur(image: Image.Image, radius: float) -> Image.Image:
+    """ GaussianBlur, при большом радиусе - на уменьшенной копии с последующим увеличением """
+
+    factor = int(radius // SCALED_BLUR_RADIUS)
+    if factor < 2:
+        return image.filter(ImageFilter.GaussianBlur(radius=radius))
+
+    small = image.reduce(factor)
+    small = small.filter(ImageFilter.GaussianBlur(radius=radius / factor))
+    return small.resize(image.size, Image.BICUBIC)
+
+
+def blur_region(image: Image.Image, rect: tuple, radius: float) -> Image.Image:
+    """ Размытая область rect картинки (как crop от размытой целиком, но без размытия лишнего)
+
+    Размывается только область с полями, из которых размытие берёт данные.
+    """
+
+    margin = get_blur_margin(radius)
+    x0 = max(0, rect[0] - margin)
+    y0 = max(0, rect[1] - margin)
+    x1 = min(image.width, rect[2] + margin)
+    y1 = min(image.height, rect[3] + margin)
+
+    blurred = gaussian_blur(image.crop((x0, y0, x1, y1)), radius)
+    return blurred.crop((rect[0] - x0, rect[1] - y0, rect[2] - x0, rect[3] - y0))
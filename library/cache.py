@@ -0,0 +1,427 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+from library.ffmpeg import probe
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def hash_data(data: Any) -> str:
+    """ Хэш данных, которые можно сериализовать в JSON (порядок ключей не важен) """
+    dump = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(dump.encode("utf-8")).hexdigest()
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    """ Хэш содержимого файла """
+    stat = path.stat()
+    return _hash_file(str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=1024)
+def _hash_file(path: str, size: int, mtime_ns: int) -> str:
+    # Размер и время изменения входят в ключ кэша, чтобы изменённый файл пересчитывался
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_temp_path(path: Path) -> Path:
+    """ Уникальный временный путь рядом с path (с тем же расширением, чтобы ffmpeg понял формат) """
+    return path.with_name(f"{path.stem}.{uuid.uuid4().hex[:8]}.part{path.suffix}")
+
+
+def is_temp_path(path: Path) -> bool:
+    return ".part" in path.suffixes
+
+
+@contextmanager
+def atomic_write(path: Path) -> Iterator[Path]:
+    """ Записать файл через временный: под именем path он появляется только целиком """
+    tmp_path = get_temp_path(path)
+    try:
+        yield tmp_path
+        tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+@contextmanager
+def file_lock(path: Path, wait: bool = True) -> Iterator[bool]:
+    """ Блокировка между процессами (и потоками) через файл: ждёт, пока её не отпустят
+
+    С wait=False не ждёт: если блокировку держит кто-то другой, отдаёт False и ничего не блокирует.
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+            except BlockingIOError:
+                acquired = False
+        else:
+            file.seek(0)
+            while True:
+                try:
+                    # LK_LOCK ждёт около 10 секунд и сдаётся, поэтому в цикле
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK if wait else msvcrt.LK_NBLCK, 1)
+                    acquired = True
+                    break
+                except OSError:
+                    if not wait:
+                        acquired = False
+                        break
+
+        if not acquired:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class CacheIndex:
+    """ Индекс файлов папки кэша в SQLite: поиск по имени без обхода папки """
+
+    filename = "index.sqlite"
+
+    # Через сколько секунд сборка без отметки о завершении считается упавшей
+    build_ttl = 24 * 60 * 60
+
+    # Служебные папки: блокировки и временные папки сборок
+    locks_dirname = "locks"
+    scratch_dirname = "scratch"
+
+    # Число файлов блокировок (имена файлов кэша распределяются по ним)
+    lock_buckets = 256
+
+    def __init__(self, folder: Path):
+        self._folder = folder
+        self._db_path = folder / self.filename
+
+        # Индекс восстанавливается по содержимому папки, если его нет
+        rebuild = not self._db_path.exists()
+        self._connection = sqlite3.connect(str(self._db_path), timeout=60)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "name TEXT PRIMARY KEY, "
+                "size INTEGER, "
+                "duration REAL, "
+                "created REAL, "
+                "accessed REAL, "
+                "input_hash TEXT)"
+            )
+            self._connection.execute("CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS builds (id TEXT PRIMARY KEY, started REAL)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS pins (name TEXT, build_id TEXT)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS probes ("
+                "path TEXT PRIMARY KEY, "
+                "size INTEGER, "
+                "mtime_ns INTEGER, "
+                "duration REAL, "
+                "sample_rate INTEGER, "
+                "channels INTEGER, "
+                "codec TEXT)"
+            )
+        if rebuild:
+            self.rebuild()
+
+    @property
+    def folder(self) -> Path:
+        return self._folder
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def is_service_file(self, path: Path) -> bool:
+        return path.name.startswith(self.filename)
+
+    def rebuild(self) -> None:
+        """ Заново заполнить индекс по файлам папки """
+        rows = []
+        for path in self._folder.iterdir():
+            if path.is_file() and not self.is_service_file(path) and not is_temp_path(path):
+                stat = path.stat()
+                rows.append((path.name, stat.st_size, None, stat.st_mtime, stat.st_mtime, None))
+        with self._connection:
+            self._connection.execute("DELETE FROM entries")
+            self._connection.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def _lookup(self, name: str) -> Optional[Path]:
+
+        row = self._connection.execute("SELECT name FROM entries WHERE name = ?", (name,)).fetchone()
+        path = self._folder / name
+
+        if row is None and path.is_file():
+            # Файл мог появиться в обход индекса (например, скопирован вручную)
+            self.add(path)
+            return path
+        if row is not None and not path.is_file():
+            self.remove(name)
+            return None
+        return None if row is None else path
+
+    def get(self, name: str, build_id: Optional[str] = None, count: bool = True) -> Optional[Path]:
+        """ Путь к файлу кэша или None, если его нет
+
+        Если указана сборка, файл закрепляется за ней и не удаляется при очистке кэша.
+        count=False - не учитывать обращение в статистике попаданий (повторная проверка).
+        """
+        return self.find([name], build_id=build_id, count=count)
+
+    def find(self, names: list[str], build_id: Optional[str] = None, count: bool = True) -> Optional[Path]:
+        """ Первый из файлов кэша, который есть (например, один трек в разных форматах) """
+
+        path = None
+        for name in names:
+            path = self._lookup(name)
+            if path is not None:
+                break
+
+        with self._connection:
+            if count:
+                key = "misses" if path is None else "hits"
+                self._connection.execute("INSERT OR IGNORE INTO stats VALUES (?, 0)", (key,))
+                self._connection.execute("UPDATE stats SET value = value + 1 WHERE key = ?", (key,))
+            if path is not None:
+                self._connection.execute("UPDATE entries SET accessed = ? WHERE name = ?", (time.time(), path.name))
+                if build_id:
+                    self._connection.execute("INSERT INTO pins VALUES (?, ?)", (path.name, build_id))
+
+        return path
+
+    def info(self, name: str) -> Optional[dict]:
+        """ Метаданные файла кэша """
+        cursor = self._connection.execute("SELECT * FROM entries WHERE name = ?", (name,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def add(
+            self,
+            path: Path,
+            duration: Optional[float] = None,
+            input_hash: Optional[str] = None,
+            build_id: Optional[str] = None
+    ) -> None:
+        """ Добавить (или обновить) файл папки кэша в индексе """
+        now = time.time()
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (path.name, path.stat().st_size, duration, now, now, input_hash)
+            )
+            if build_id:
+                self._connection.execute("INSERT INTO pins VALUES (?, ?)", (path.name, build_id))
+
+    def remove(self, name: str) -> None:
+        with self._connection:
+            self._connection.execute("DELETE FROM entries WHERE name = ?", (name,))
+
+    def probe(self, path: Path) -> dict:
+        """ Сведения о медиафайле (длительность, частота, каналы, кодек)
+
+        Файл читается ffmpeg только при первом обращении или после изменения
+        (размер и время изменения не совпали с сохранёнными).
+        """
+
+        stat = path.stat()
+        key = str(path.resolve())
+        row = self._connection.execute(
+            "SELECT duration, sample_rate, channels, codec FROM probes WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (key, stat.st_size, stat.st_mtime_ns)
+        ).fetchone()
+        if row is not None:
+            return dict(zip(("duration", "sample_rate", "channels", "codec"), row))
+
+        info = probe(path)
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key, stat.st_size, stat.st_mtime_ns,
+                    info["duration"], info["sample_rate"], info["channels"], info["codec"]
+                )
+            )
+        return info
+
+    # ================================= #
+    # Блокировки и временные папки сборок #
+    # ================================= #
+
+    @contextmanager
+    def lock(self, name: str) -> Iterator[None]:
+        """ Блокировка файла кэша: пока его делает одна сборка, другие ждут,
+        а затем находят готовый файл вместо того, чтобы делать его ещё раз
+        """
+        bucket = int(hashlib.sha256(name.encode("utf-8")).hexdigest(), 16) % self.lock_buckets
+        with file_lock(self._folder / self.locks_dirname / f"{bucket:03d}.lock"):
+            yield
+
+    @contextmanager
+    def scratch(self, build_id: Optional[str] = None) -> Iterator[Path]:
+        """ Отдельная временная папка (внутри папки сборки), удаляется после использования """
+        path = self._folder / self.scratch_dirname / (build_id or "common") / uuid.uuid4().hex
+        path.mkdir(parents=True)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    # =========== #
+    # Учёт сборок #
+    # =========== #
+
+    def start_build(self) -> str:
+        """ Зарегистрировать сборку, файлы которой нельзя удалять """
+        build_id = uuid.uuid4().hex
+        with self._connection:
+            self._connection.execute("INSERT INTO builds VALUES (?, ?)", (build_id, time.time()))
+        return build_id
+
+    def finish_build(self, build_id: str) -> None:
+        with self._connection:
+            self._connection.execute("DELETE FROM pins WHERE build_id = ?", (build_id,))
+            self._connection.execute("DELETE FROM builds WHERE id = ?", (build_id,))
+        shutil.rmtree(self._folder / self.scratch_dirname / build_id, ignore_errors=True)
+
+    @contextmanager
+    def build(self) -> Iterator[str]:
+        build_id = self.start_build()
+        try:
+            yield build_id
+        finally:
+            self.finish_build(build_id)
+
+    def pinned(self) -> set[str]:
+        """ Файлы, которые используют незавершённые сборки """
+        with self._connection:
+            stale = time.time() - self.build_ttl
+            self._connection.execute(
+                "DELETE FROM pins WHERE build_id IN (SELECT id FROM builds WHERE started < ?)", (stale,)
+            )
+            self._connection.execute("DELETE FROM builds WHERE started < ?", (stale,))
+        rows = self._connection.execute("SELECT DISTINCT name FROM pins").fetchall()
+        return {row[0] for row in rows}
+
+    # ============ #
+    # Очистка кэша #
+    # ============ #
+
+    def prune(self, max_bytes: Optional[int] = None, max_age: Optional[float] = None) -> list[str]:
+        """ Удалить давно не использованные файлы, чтобы уложиться в бюджет
+
+        max_bytes - допустимый общий размер, max_age - допустимое время (в секундах)
+        с последнего использования. Файлы незавершённых сборок не удаляются.
+        """
+
+        pinned = self.pinned()
+        self.remove_leftovers()
+        rows = self._connection.execute("SELECT name, size, accessed FROM entries ORDER BY accessed").fetchall()
+        total_size = sum(size for _, size, _ in rows)
+        oldest_allowed = time.time() - max_age if max_age else None
+
+        removed = []
+        for name, size, accessed in rows:
+            too_old = oldest_allowed is not None and accessed < oldest_allowed
+            too_big = max_bytes is not None and total_size > max_bytes
+            if not (too_old or too_big):
+                continue
+            if name in pinned:
+                continue
+            (self._folder / name).unlink(missing_ok=True)
+            self.remove(name)
+            total_size -= size
+            removed.append(name)
+
+        return removed
+
+    def remove_leftovers(self) -> None:
+        """ Удалить недописанные файлы и временные папки упавших сборок """
+
+        stale = time.time() - self.build_ttl
+        for path in self._folder.iterdir():
+            if path.is_file() and is_temp_path(path) and path.stat().st_mtime < stale:
+                path.unlink(missing_ok=True)
+
+        scratch = self._folder / self.scratch_dirname
+        if scratch.is_dir():
+            running = {row[0] for row in self._connection.execute("SELECT id FROM builds").fetchall()}
+            for path in scratch.iterdir():
+                if path.name not in running and path.stat().st_mtime < stale:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def stats(self) -> dict:
+        """ Общая статистика кэша """
+        counters = dict(self._connection.execute("SELECT key, value FROM stats").fetchall())
+        count, total_size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "count": count,
+            "size": total_size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+        }
+
+    def largest(self, limit: int = 10) -> list[tuple[str, int]]:
+        """ Самые большие файлы кэша """
+        return self._connection.execute(
+            "SELECT name, size FROM entries ORDER BY size DESC LIMIT ?", (limit,)
+        ).fetchall()
+
+
+class _ThreadIndexes(dict):
+    """ Индексы одного потока: их соединения закрываются, когда поток (например, этапа конвейера)
+    завершается и его данные удаляются
+    """
+
+    def __del__(self):
+        for (_, pid), index in self.items():
+            if pid == os.getpid():
+                index.close()
+
+
+_local = threading.local()
+
+
+def get_index(folder: Path) -> CacheIndex:
+    """ Индекс папки кэша (одно соединение на поток: SQLite не разделяет их между потоками) """
+    if not hasattr(_local, "indexes"):
+        _local.indexes = _ThreadIndexes()
+    # Процесс, запущенный через fork, получает данные потока родителя: его соединения не используются
+    key = (folder, os.getpid())
+    if key not in _local.indexes:
+        _local.indexes[key] = CacheIndex(folder)
+    return _local.indexes[key]
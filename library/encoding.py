@@ -0,0 +1,64 @@
+import os
+from typing import Optional
+
+
+# Настройки кодирования по умолчанию (секция encoding в config.yml).
+# Кадры почти не меняются, поэтому быстрый preset и tune stillimage
+# почти не ухудшают картинку, а кодирование заметно ускоряют.
+DEFAULT_ENCODING = {
+    "codec": "libx264",
+    "preset": "veryfast",
+    "tune": "stillimage",
+    "crf": 23,
+    "bitrate": None,
+    "audio_bitrate": "192k",
+    "threads": "auto",
+    "pixel_format": "yuv420p"
+}
+
+
+def get_encoding(config: Optional[dict] = None) -> dict:
+    """ Настройки кодирования: заданные в конфиге поверх настроек по умолчанию """
+    return {**DEFAULT_ENCODING, **(config or {})}
+
+
+def get_threads(encoding: dict, jobs: int = 1) -> int:
+    """ Число потоков кодировщика; "auto" - ядра поровну на все одновременные задачи """
+    threads = encoding["threads"]
+    if not threads or threads == "auto":
+        return max(1, (os.cpu_count() or 1) // max(1, jobs))
+    return int(threads)
+
+
+def resolve_threads(encoding: dict, jobs: int = 1) -> dict:
+    """ Настройки с числом потоков вместо "auto" (для jobs одновременных кодирований) """
+    return {**encoding, "threads": get_threads(encoding, jobs)}
+
+
+def get_encoding_key(encoding: dict) -> dict:
+    """ Настройки, от которых зависит результат (для ключей кэша): всё, кроме потоков """
+    return {key: value for key, value in encoding.items() if key != "threads"}
+
+
+def get_quality_args(encoding: dict) -> list[str]:
+    """ Аргументы ffmpeg для качества и формата кадра (без кодека и preset) """
+
+    args = []
+    if encoding["tune"]:
+        args += ["-tune", str(encoding["tune"])]
+    if encoding["bitrate"]:
+        args += ["-b:v", str(encoding["bitrate"])]
+    elif encoding["crf"] is not None:
+        args += ["-crf", str(encoding["crf"])]
+    args += ["-pix_fmt", str(encoding["pixel_format"])]
+    return args
+
+
+def get_video_args(encoding: dict, jobs: int = 1) -> list[str]:
+    """ Все аргументы ffmpeg для кодирования видео """
+    return [
+        "-c:v", str(encoding["codec"]),
+        "-preset", str(encoding["preset"]),
+        *get_quality_args(encoding),
+        "-threads", str(get_threads(encoding, jobs))
+    ]
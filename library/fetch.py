@@ -0,0 +1,90 @@
+import shutil
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+
+from library.cache import get_index
+from library.report import BuildReport, file_size
+from library.utils import download_youtube_audio
+
+
+# Форматы, в которых треки лежат в кэше (mp3 - записи, сделанные до хранения исходной дорожки)
+AUDIO_EXTENSIONS = (".m4a", ".webm", ".mp3", ".opus", ".ogg", ".wav", ".flac")
+
+
+def get_song_id(url: str) -> str:
+    return url.replace("https://youtube.com/watch?v=", "")
+
+
+class Fetcher(ABC):
+    """ Источник треков """
+
+    @abstractmethod
+    def fetch(self, url: str, save_dir: Path, song_id: str) -> Path:
+        """ Сохранить трек в save_dir ({song_id} с расширением формата) и вернуть путь к нему """
+        ...
+
+
+class YouTubeFetcher(Fetcher):
+    """ Скачивание звуковой дорожки с YouTube (в исходном кодеке, без перекодирования) """
+
+    def fetch(self, url: str, save_dir: Path, song_id: str) -> Path:
+        return download_youtube_audio(url, save_dir=save_dir, name=song_id)
+
+
+class LocalFetcher(Fetcher):
+    """ Треки из локальной папки ({song_id}.m4a, {song_id}.mp3 и т.д.), например для работы без сети """
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+
+    def fetch(self, url: str, save_dir: Path, song_id: str) -> Path:
+        for extension in AUDIO_EXTENSIONS:
+            src = self.folder / f"{song_id}{extension}"
+            if src.exists():
+                dst = save_dir / src.name
+                shutil.copy(src, dst)
+                return dst
+        raise FileNotFoundError(f"Song {url} not found in {self.folder}")
+
+
+def get_fetcher(fetch_dir: Optional[Path] = None) -> Fetcher:
+    return LocalFetcher(fetch_dir) if fetch_dir else YouTubeFetcher()
+
+
+def fetch_song(
+        url: str,
+        cache_dir: Path,
+        fetcher: Fetcher,
+        build_id: Optional[str] = None,
+        report: Optional[BuildReport] = None
+) -> Path:
+    """ Путь к звуку трека в папке кэша (получается через fetcher, если его там нет) """
+
+    song_id = get_song_id(url)
+    index = get_index(cache_dir)
+    report = report or BuildReport()
+
+    with report.stage("cache_lookup", song=song_id) as record:
+        audio_path = index.find([f"{song_id}{extension}" for extension in AUDIO_EXTENSIONS], build_id=build_id)
+        record["hit"] = audio_path is not None
+
+    if audio_path is None:
+        # Один трек, нужный нескольким сборкам сразу, скачивается один раз:
+        # остальные ждут блокировку и находят его в кэше
+        with index.lock(song_id):
+            audio_path = index.find(
+                [f"{song_id}{extension}" for extension in AUDIO_EXTENSIONS],
+                build_id=build_id,
+                count=False
+            )
+            if audio_path is None:
+                with report.stage("download", song=song_id) as record:
+                    # Скачивание идёт во временную папку сборки, в кэш попадает только целый файл
+                    with index.scratch(build_id) as scratch:
+                        path = fetcher.fetch(url, scratch, song_id)
+                        audio_path = path.replace(cache_dir / path.name)
+                    index.add(audio_path, build_id=build_id)
+                    record["bytes_written"] = file_size(audio_path)
+
+    return audio_path
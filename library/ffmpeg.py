@@ -0,0 +1,221 @@
+import math
+import os
+import re
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Iterable, Optional
+
+import imageio_ffmpeg
+
+from library.encoding import get_encoding, get_video_args
+
+
+def get_ffmpeg() -> str:
+    """ Путь к ffmpeg из imageio-ffmpeg (с учётом IMAGEIO_FFMPEG_EXE) """
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def run_ffmpeg(*args) -> None:
+    process = subprocess.run(
+        [get_ffmpeg(), "-y", "-hide_banner", "-loglevel", "error", *map(str, args)],
+        capture_output=True,
+        text=True
+    )
+    if process.returncode != 0:
+        raise Exception(f"ffmpeg failed: {process.stderr.strip()}")
+
+
+def probe(path: Path) -> dict:
+    """ Длительность и параметры звука файла по заголовку (без декодирования) """
+
+    # ffmpeg без выходного файла завершается с ошибкой, но успевает вывести сведения о входе
+    process = subprocess.run(
+        [get_ffmpeg(), "-hide_banner", "-i", str(path)],
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+        errors="replace"
+    )
+    output = process.stderr
+
+    match = re.search(r"Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)", output)
+    if match is None:
+        raise Exception(f"Failed to probe {path}: {output.strip()}")
+    hours, minutes, seconds = match.groups()
+    info = {
+        "duration": int(hours) * 3600 + int(minutes) * 60 + float(seconds),
+        "sample_rate": None,
+        "channels": None,
+        "codec": None
+    }
+
+    match = re.search(r"Stream #.*?: Audio: (\w+)[^,]*, (\d+) Hz, ([^,\n]+)", output)
+    if match:
+        codec, sample_rate, layout = match.groups()
+        info["codec"] = codec
+        info["sample_rate"] = int(sample_rate)
+        channels = {"mono": 1, "stereo": 2}.get(layout)
+        if channels is None:
+            match = re.match(r"(\d+)(?:\.(\d+))?", layout)
+            channels = sum(int(x) for x in match.groups() if x) if match else None
+        info["channels"] = channels
+
+    return info
+
+
+# Длительность (в секундах) отрезка, который кодируется для неподвижной картинки:
+# видео любой длины склеивается из его копий, ключевой кадр - в начале каждой копии
+STILL_CLIP_SECONDS = 60
+
+
+def encode_still(
+        image: Path,
+        save_path: Path,
+        duration: float,
+        audio: Optional[Path] = None,
+        fps: int = 1,
+        encoding: Optional[dict] = None
+) -> Path:
+    """ Закодировать неподвижную картинку как видео (звук, если есть, копируется без перекодирования)
+
+    Кодируется только отрезок в STILL_CLIP_SECONDS (один ключевой кадр, остальные
+    ссылаются на него), а видео нужной длины склеивается из его копий без
+    перекодирования, поэтому время не зависит от длительности.
+    encoding - настройки кодирования (см. library.encoding).
+    """
+
+    clip_seconds = min(duration, STILL_CLIP_SECONDS)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clip_path = Path(tmp_dir) / "clip.mp4"
+        # Картинка декодируется один раз и повторяется фильтром (-loop 1 декодировал бы её на каждый кадр)
+        args = ["-framerate", fps, "-i", image, "-vf", f"loop=loop={math.ceil(clip_seconds * fps) - 1}:size=1"]
+        args += ["-t", clip_seconds, *get_video_args(encoding or get_encoding())]
+        # Без B-кадров порядок кадров совпадает с порядком пакетов, и склейка обрезается точно по -t
+        args += ["-r", fps, "-g", math.ceil(clip_seconds * fps), "-bf", 0, clip_path]
+        run_ffmpeg(*args)
+
+        copies = math.ceil(duration / clip_seconds)
+        concat_videos([clip_path] * copies, save_path, audio=audio, duration=duration)
+
+    return save_path
+
+
+def concat_videos(
+        videos: list[Path],
+        save_path: Path,
+        audio: Optional[Path] = None,
+        audio_bitrate: Optional[str] = None,
+        duration: Optional[float] = None
+) -> Path:
+    """ Склеить видео с одинаковыми параметрами кодирования без перекодирования
+
+    Если передан audio, его дорожка (тоже без перекодирования) заменяет звук видео.
+    С audio_bitrate звук кодируется в mp3 (как у moviepy), duration - длительность
+    результата (недостающий звук дополняется тишиной).
+    """
+
+    # Список файлов для concat demuxer
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", encoding="utf-8", delete=False) as file:
+        for video in videos:
+            path = video.resolve().as_posix().replace("'", r"'\''")
+            file.write(f"file '{path}'\n")
+        list_path = file.name
+
+    args = ["-f", "concat", "-safe", "0", "-i", list_path]
+    if audio:
+        args += ["-i", audio, "-map", "0:v", "-map", "1:a"]
+    args += ["-c", "copy"]
+    if audio and audio_bitrate:
+        args += ["-c:a", "libmp3lame", "-b:a", audio_bitrate]
+        if duration:
+            args += ["-af", "apad"]
+    if duration:
+        args += ["-t", duration]
+    args += ["-movflags", "+faststart", save_path]
+
+    try:
+        run_ffmpeg(*args)
+    finally:
+        os.remove(list_path)
+
+    return save_path
+
+
+def encode_overlay(
+        background: Path,
+        regions: Iterable,
+        box: tuple,
+        save_path: Path,
+        duration: float,
+        fps: int = 1,
+        select: Optional[str] = None,
+        audio: Optional[Path] = None,
+        audio_bitrate: Optional[str] = None,
+        encoding: Optional[dict] = None
+) -> Path:
+    """ Закодировать видео из неподвижного фона и меняющейся области поверх него
+
+    regions - области (x0, y0, x1, y1) = box каждого кадра, массивы rgb24 или байты.
+    Фон декодируется и переводится в формат кадра один раз, а из Python в ffmpeg
+    передаются только области, поэтому затраты растут с площадью области, а не кадра.
+
+    select - выражение фильтра select: кодируются только выбранные кадры, а остальные
+    не попадают в видео (предыдущий кадр показывается дольше, частота кадров переменная).
+    Кодировщик тратит на кадр одинаковое время, даже если кадр не изменился.
+
+    Звук (если есть) кодируется в mp3 и дополняется тишиной до duration, как у moviepy.
+    """
+
+    encoding = encoding or get_encoding()
+    x0, y0, x1, y1 = box
+
+    args = ["-framerate", fps, "-i", background]
+    args += ["-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{x1 - x0}x{y1 - y0}", "-framerate", fps, "-i", "-"]
+    # Невыбранные кадры отбрасываются из обоих входов до наложения, поэтому на них
+    # не тратятся ни наложение, ни перевод области в формат кадра
+    # Фон повторяется ровно на длину видео: иначе после последнего выбранного кадра
+    # фильтр select бесконечно отбрасывал бы кадры фона
+    select = f",select='{select}'" if select else ""
+    graph = (
+        f"[0:v]format={encoding['pixel_format']},loop=loop={math.ceil(duration * fps) - 1}:size=1{select}[bg];"
+        f"[1:v]null{select}[fg];"
+        f"[bg][fg]overlay={x0}:{y0}:shortest=1:format=auto[v]"
+    )
+    maps = ["-map", "[v]"]
+    if audio:
+        args += ["-i", audio]
+        graph += ";[2:a]apad[a]"
+        maps += ["-map", "[a]", "-c:a", "libmp3lame"]
+        if audio_bitrate:
+            maps += ["-b:a", audio_bitrate]
+    args += ["-filter_complex", graph, *maps, "-t", duration, *get_video_args(encoding)]
+    # При переменной частоте кадров B-кадры сдвигают dts последнего пакета далеко от его pts,
+    # и mp4 записывает длительность короче видео (склейка по ней теряет время)
+    args += ["-vsync", "vfr", "-bf", 0] if select else ["-r", fps]
+    args += ["-movflags", "+faststart", save_path]
+
+    # Ошибки ffmpeg пишутся в файл, чтобы полный канал stderr не остановил запись кадров
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(
+            [get_ffmpeg(), "-y", "-hide_banner", "-loglevel", "error", *map(str, args)],
+            stdin=subprocess.PIPE,
+            stderr=errors
+        )
+        try:
+            for region in regions:
+                process.stdin.write(region)
+            process.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg завершился раньше времени, причина будет в его выводе
+            pass
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        process.wait()
+        if process.returncode != 0:
+            errors.seek(0)
+            raise Exception(f"ffmpeg failed: {errors.read().decode('utf-8', errors='replace').strip()}")
+
+    return save_path
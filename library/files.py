@@ -1,11 +1,14 @@
+import csv
+import json
 import shutil
 from abc import ABC, abstractmethod
 from collections import OrderedDict
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Union
+from typing import Any, Iterator, Union
 
 import openpyxl
+from openpyxl.utils import get_column_letter
 import yaml
 
 
@@ -32,10 +35,7 @@ class Folder:
         return [x for x in self.path.iterdir() if x.is_file()]
 
     def contains_filename(self, filename: str) -> bool:
-        for filepath in self.files():
-            if filepath.name == filename:
-                return True
-        return False
+        return (self.path / filename).is_file()
 
     @contextmanager
     def clear_after(self):
@@ -51,10 +51,8 @@ class Folder:
         ]
 
     def find_by_name(self, name: str) -> list[Path]:
-        return [
-            child for child in self.path.iterdir()
-            if child.name == name
-        ]
+        path = self.path / name
+        return [path] if path.exists() else []
 
 
 class File(ABC):
@@ -96,32 +94,37 @@ class YAMLFile(File):
             yaml.safe_dump(data, file)
 
 
-class XLSXFile(File):
+class TableFile(File):
+    """ Таблица: первая строка - заголовки, остальные читаются как словари """
+
+    def read(self) -> list[OrderedDict]:
+        return list(self.iter_rows())
+
+    @abstractmethod
+    def iter_rows(self) -> Iterator[OrderedDict]:
+        """ Строки по одной, не загружая весь файл в память """
+        ...
+
+
+class XLSXFile(TableFile):
 
     def __init__(self, path: Path):
         super(XLSXFile, self).__init__(path)
         if path.suffix != ".xlsx":
             raise Exception("The file extension must be .xlsx")
 
-    def read(self) -> list[OrderedDict]:
-
-        wb = openpyxl.load_workbook(str(self._path))
-        ws = wb.active
-        if ws.max_row == 0:
-            return []
-
-        keys = []
-        for column in range(1, ws.max_column + 1):
-            keys.append(ws.cell(1, column).value)
-
-        data = []
-        for row in range(2, ws.max_row + 1):
-            dct = OrderedDict()
-            for column, key in enumerate(keys, start=1):
-                dct[key] = ws.cell(row, column).value
-            data.append(dct)
+    def iter_rows(self) -> Iterator[OrderedDict]:
 
-        return data
+        wb = openpyxl.load_workbook(str(self._path), read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            keys = next(rows, None)
+            if keys is None:
+                return
+            for values in rows:
+                yield OrderedDict(zip(keys, values))
+        finally:
+            wb.close()
 
     def write(self, data: list[OrderedDict]) -> None:
 
@@ -131,27 +134,72 @@ class XLSXFile(File):
             wb.save(str(self._path))
             return
 
-        for column, key in enumerate(data[0].keys(), start=1):
-            ws.cell(1, column, key)
+        keys = list(data[0].keys())
+        ws.append(keys)
+        widths = [len(str(key)) for key in keys]
 
-        for row, dct in enumerate(data, start=2):
-            for column, value in enumerate(dct.values(), start=1):
-                ws.cell(row, column, value)
+        for dct in data:
+            values = list(dct.values())
+            ws.append(values)
+            for column, value in enumerate(values):
+                widths[column] = max(widths[column], len(str(value)))
 
-        self._adjust_columns_width(ws)
+        for column, width in enumerate(widths, start=1):
+            ws.column_dimensions[get_column_letter(column)].width = width
         wb.save(str(self._path))
 
-    @staticmethod
-    def _adjust_columns_width(sheet) -> None:
-        for col in sheet.columns:
-            max_length = 0
-            column = col[0].column_letter  # Get the column name
-            for cell in col:
-                try:  # Necessary to avoid error on empty cells
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            # adjusted_width = (max_length + 2) * 1.2
-            adjusted_width = max_length
-            sheet.column_dimensions[column].width = adjusted_width
+
+class CSVFile(TableFile):
+
+    def __init__(self, path: Path):
+        super(CSVFile, self).__init__(path)
+        if path.suffix != ".csv":
+            raise Exception("The file extension must be .csv")
+
+    def iter_rows(self) -> Iterator[OrderedDict]:
+        with open(self._path, "r", encoding="utf-8-sig", newline="") as file:
+            for row in csv.DictReader(file):
+                # Пустые ячейки читаются как None, как и в xlsx
+                yield OrderedDict((key, value if value != "" else None) for key, value in row.items())
+
+    def write(self, data: list[OrderedDict]) -> None:
+        with open(self._path, "w", encoding="utf-8", newline="") as file:
+            if not data:
+                return
+            writer = csv.DictWriter(file, fieldnames=list(data[0].keys()))
+            writer.writeheader()
+            writer.writerows(data)
+
+
+class JSONLinesFile(TableFile):
+
+    def __init__(self, path: Path):
+        super(JSONLinesFile, self).__init__(path)
+        if path.suffix != ".jsonl":
+            raise Exception("The file extension must be .jsonl")
+
+    def iter_rows(self) -> Iterator[OrderedDict]:
+        with open(self._path, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield OrderedDict(json.loads(line))
+
+    def write(self, data: list[OrderedDict]) -> None:
+        with open(self._path, "w", encoding="utf-8") as file:
+            for dct in data:
+                file.write(json.dumps(dct, ensure_ascii=False) + "\n")
+
+
+TABLE_FILES = {
+    ".xlsx": XLSXFile,
+    ".csv": CSVFile,
+    ".jsonl": JSONLinesFile
+}
+
+
+def get_table_file(path: Path) -> TableFile:
+    """ Таблица нужного формата по расширению файла """
+
+    if path.suffix not in TABLE_FILES:
+        raise Exception(f"Unsupported table format: {path.suffix} (expected one of {', '.join(TABLE_FILES)})")
+    return TABLE_FILES[path.suffix](path)
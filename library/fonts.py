@@ -0,0 +1,149 @@
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+
+@lru_cache(maxsize=None)
+def load_font(path: Path, size: int) -> ImageFont.FreeTypeFont:
+    """ Загрузить шрифт (один раз на процесс для каждой пары путь-размер) """
+    return ImageFont.truetype(str(path), size)
+
+
+class GlyphAtlas:
+    """ Заранее отрисованные символы с обводкой для быстрого вывода короткого текста """
+
+    def __init__(
+            self,
+            font: ImageFont.FreeTypeFont,
+            fill: str,
+            stroke_fill: str,
+            stroke_width: int,
+            charset: str = "0123456789:"
+    ):
+        self._fill = fill
+        self._stroke_fill = stroke_fill
+        self._glyphs = {}
+        self._glyph_arrays = {}
+        self._advances = {}
+
+        for char in charset:
+            left, top, right, bottom = font.getbbox(char, stroke_width=stroke_width)
+            size = (max(1, right - left), max(1, bottom - top))
+
+            # Маска обводки (вместе с заливкой, как её рисует PIL)
+            stroke_mask = Image.new("L", size, 0)
+            ImageDraw.Draw(stroke_mask).text(
+                (-left, -top), char, font=font, fill=255, stroke_fill=255, stroke_width=stroke_width
+            )
+
+            # Маска заливки в тех же координатах
+            fill_mask = Image.new("L", size, 0)
+            ImageDraw.Draw(fill_mask).text(
+                (-left, -top), char, font=font, fill=255, stroke_fill=0, stroke_width=stroke_width
+            )
+
+            self._glyphs[char] = (stroke_mask, fill_mask, left, top)
+            self._glyph_arrays[char] = (
+                _get_blend_arrays(stroke_mask, stroke_fill),
+                _get_blend_arrays(fill_mask, fill)
+            )
+            self._advances[char] = font.getlength(char)
+
+    def length(self, text: str) -> float:
+        """ Ширина текста (аналог ImageDraw.textlength) """
+        return sum(self._advances[char] for char in text)
+
+    def _positions(self, xy: tuple, text: str) -> list[tuple]:
+        x, y = xy
+        positions = []
+        for char in text:
+            _, _, left, top = self._glyphs[char]
+            positions.append((round(x) + left, round(y) + top, char))
+            x += self._advances[char]
+        return positions
+
+    def bbox(self, xy: tuple, text: str) -> tuple:
+        """ Границы пикселей, которые затронет draw (x0, y0, x1, y1 - не включая x1 и y1) """
+        boxes = []
+        for px, py, char in self._positions(xy, text):
+            stroke_mask = self._glyphs[char][0]
+            boxes.append((px, py, px + stroke_mask.width, py + stroke_mask.height))
+        if not boxes:
+            return 0, 0, 0, 0
+        return min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes)
+
+    def draw(self, image: Image.Image, xy: tuple, text: str) -> None:
+        """ Вывести текст, копируя готовые символы (позиции округляются до пикселя) """
+
+        positions = [(px, py, *self._glyphs[char][:2]) for px, py, char in self._positions(xy, text)]
+
+        # Сначала обводка всех символов, затем заливка, чтобы обводка
+        # соседнего символа не перекрывала заливку
+        for px, py, stroke_mask, _ in positions:
+            image.paste(self._stroke_fill, (px, py), stroke_mask)
+        for px, py, _, fill_mask in positions:
+            image.paste(self._fill, (px, py), fill_mask)
+
+    def draw_arrays(self, arrays: np.ndarray, xys: list[tuple], texts: list[str]) -> None:
+        """ То же, что draw, но сразу для нескольких кадров в массиве RGB
+        (кадры x высота x ширина x 3, uint8): в кадр i выводится texts[i] в точке xys[i]
+
+        Одинаковые символы в одинаковых местах накладываются на все кадры разом.
+        Смешивание по маске повторяет целочисленную арифметику Image.paste,
+        поэтому результат совпадает с draw до пикселя.
+        """
+
+        positions = [self._positions(xy, text) for xy, text in zip(xys, texts)]
+        slots = max((len(frame_positions) for frame_positions in positions), default=0)
+
+        # Сначала обводка, затем заливка (как в draw)
+        for layer in (0, 1):
+            for slot in range(slots):
+                groups = {}
+                for frame, frame_positions in enumerate(positions):
+                    if slot < len(frame_positions):
+                        groups.setdefault(frame_positions[slot], []).append(frame)
+                for (px, py, char), frames in groups.items():
+                    # Подряд идущие кадры берутся срезом, без копирования
+                    if frames[-1] - frames[0] == len(frames) - 1:
+                        frames = slice(frames[0], frames[-1] + 1)
+                    _blend(arrays, frames, px, py, *self._glyph_arrays[char][layer])
+
+
+def _get_blend_arrays(mask: Image.Image, color: str) -> tuple[np.ndarray, np.ndarray]:
+    """ Заготовки для заливки цветом по маске: 255 - маска и цвет, умноженный на маску (+128 для округления) """
+    mask = np.asarray(mask, dtype=np.uint16)[:, :, None]
+    rgb = np.array(ImageColor.getcolor(color, "RGB"), dtype=np.uint16)
+    return 255 - mask, mask * rgb + 128
+
+
+def _blend(arrays: np.ndarray, frames, x: int, y: int, inverse: np.ndarray, ink: np.ndarray) -> None:
+    """ Залить кадры frames по маске (как Image.paste(color, (x, y), mask)), с обрезкой по краям
+
+    Арифметика та же, что в PIL: (dst * (255 - m) + color * m + 128) / 255 с округлением через сдвиги.
+    """
+
+    height, width = arrays.shape[1:3]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + inverse.shape[1], width), min(y + inverse.shape[0], height)
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    crop = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+    tmp = arrays[frames, y0:y1, x0:x1] * inverse[crop] + ink[crop]
+    arrays[frames, y0:y1, x0:x1] = ((tmp >> 8) + tmp) >> 8
+
+
+@lru_cache(maxsize=None)
+def get_glyph_atlas(
+        path: Path,
+        size: int,
+        fill: str,
+        stroke_fill: str,
+        stroke_width: int
+) -> GlyphAtlas:
+    """ Атлас символов для времени "MM:SS" (один раз на процесс для каждого стиля) """
+    font = load_font(path, size)
+    return GlyphAtlas(font, fill=fill, stroke_fill=stroke_fill, stroke_width=stroke_width)
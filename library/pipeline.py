@@ -0,0 +1,114 @@
+import threading
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Iterable, Iterator
+
+from library.process import TaskError
+
+
+class Stage:
+    """ Этап конвейера: функция над элементом и число потоков, которые её выполняют """
+
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: int = 1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+class _Done:
+    """ Метка конца очереди """
+
+
+def run_pipeline(items: Iterable, stages: list[Stage], queue_size: int = 2) -> Iterator:
+    """ Пропустить элементы через этапы, работающие одновременно
+
+    Между этапами стоят очереди ограниченного размера, поэтому быстрый этап
+    не убегает далеко вперёд медленного. Результаты отдаются в исходном порядке
+    по мере готовности. Ошибка любого этапа останавливает конвейер и выбрасывается
+    как TaskError с номером элемента.
+    """
+
+    queues = [Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+    errors = []
+
+    def put(queue: Queue, value: Any) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(value, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(queue: Queue) -> Any:
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+        return _Done
+
+    def feed() -> None:
+        try:
+            for idx, item in enumerate(items):
+                if not put(queues[0], (idx, item)):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+            return
+        for _ in range(stages[0].workers):
+            put(queues[0], _Done)
+
+    def work(number: int, stage: Stage, remaining: list, lock: threading.Lock) -> None:
+        while True:
+            value = get(queues[number])
+            if value is _Done:
+                break
+            idx, item = value
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                errors.append(TaskError(idx, e))
+                stop.set()
+                return
+            if not put(queues[number + 1], (idx, result)):
+                return
+
+        # Последний поток этапа передаёт метку конца следующему этапу
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            next_workers = stages[number + 1].workers if number + 1 < len(stages) else 1
+            for _ in range(next_workers):
+                put(queues[number + 1], _Done)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for number, stage in enumerate(stages):
+        remaining = [stage.workers]
+        lock = threading.Lock()
+        for _ in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(number, stage, remaining, lock), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    # Отдаём результаты по порядку, придерживая те, что пришли раньше своей очереди
+    ready = {}
+    next_idx = 0
+    try:
+        while True:
+            value = get(queues[-1])
+            if value is _Done:
+                break
+            idx, result = value
+            ready[idx] = result
+            while next_idx in ready:
+                yield ready.pop(next_idx)
+                next_idx += 1
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
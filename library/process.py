@@ -1,10 +1,65 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import Process, Queue
+from queue import Empty
 from typing import Any, Callable
 
 
+class ProcessError(Exception):
+    """ Функция в отдельном процессе завершилась с ошибкой """
+
+
+class TaskError(Exception):
+    """ Обработка одного из элементов (например, в конвейере) завершилась с ошибкой """
+
+    def __init__(self, index: int, error: BaseException):
+        super(TaskError, self).__init__(f"Item #{index} failed: {error!r}")
+        self.index = index
+        self.error = error
+
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def warm_up(_: int) -> int:
+    """ Пустая задача: процесс пула стартует (и загружает модули) до первого задания """
+    return os.getpid()
+
+
+def start_executor(workers: int) -> ProcessPoolExecutor:
+    """ Пул процессов, все процессы которого уже запущены
+
+    Пул запускает процессы при первом submit. Если это случится в потоке, пока
+    другой поток запускает ffmpeg, процесс пула (fork) унаследует канал, по которому
+    subprocess ждёт запуска программы, и тот поток зависнет навсегда. Поэтому пул
+    запускается заранее, пока других потоков нет.
+    """
+    executor = ProcessPoolExecutor(max_workers=workers)
+    list(executor.map(warm_up, range(workers)))
+    return executor
+
+
 def run_with_queue(func: Callable, queue: Queue, *args, **kwargs) -> None:
-    result = func(*args, **kwargs)
-    queue.put(result)
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+    else:
+        queue.put((True, result))
+
+
+def call_with_traceback(func: Callable, kwargs: dict) -> Any:
+    """ Вызвать func, превратив ошибку в ProcessError с текстом трейсбэка
+
+    Исключения сторонних библиотек не всегда переживают pickle, а такое
+    исключение ломает весь пул процессов.
+    """
+    try:
+        return func(**kwargs)
+    except Exception:
+        raise ProcessError(traceback.format_exc())
 
 
 def run_as_process(func: Callable, *args, **kwargs) -> Any:
@@ -18,5 +73,19 @@ def run_as_process(func: Callable, *args, **kwargs) -> Any:
 
     process = Process(target=run_with_queue, args=args, kwargs=kwargs)
     process.start()
+
+    # Результат забираем до join, иначе большой результат заблокирует процесс.
+    # Если процесс умер, не положив результат, ждать нечего.
+    while True:
+        try:
+            ok, result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                raise ProcessError(f"Process exited with code {process.exitcode} without a result")
+
     process.join()
-    return queue.get()
+    if not ok:
+        raise ProcessError(result)
+    return result
+
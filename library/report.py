@@ -0,0 +1,114 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb(children: bool = False) -> Optional[float]:
+    """ Пиковая память процесса (или самого большого из завершившихся дочерних)
+
+    None, если узнать её нельзя (на Windows нет модуля resource).
+    """
+    if resource is None:
+        return None
+    # ru_maxrss в килобайтах, на macOS - в байтах
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss / unit
+
+
+def file_size(path: Path) -> int:
+    return path.stat().st_size if path.exists() else 0
+
+
+class BuildReport:
+    """ Замеры этапов сборки: длительность, объём прочитанного и записанного,
+    попадания в кэш и пиковая память процесса, выполнившего этап
+    """
+
+    filename = "build_report.json"
+
+    def __init__(self):
+        self._records = []
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    @property
+    def records(self) -> list[dict]:
+        with self._lock:
+            return list(self._records)
+
+    def add(self, stage: str, **fields) -> None:
+        record = {"stage": stage, "pid": os.getpid(), **fields}
+        with self._lock:
+            self._records.append(record)
+
+    def extend(self, records: list[dict]) -> None:
+        """ Добавить замеры, сделанные в другом процессе """
+        with self._lock:
+            self._records.extend(records)
+
+    @contextmanager
+    def stage(self, stage: str, **fields) -> Iterator[dict]:
+        """ Замерить этап
+
+        В отданный словарь можно дописать bytes_read, bytes_written и hit (попадание в кэш).
+        """
+        record = dict(fields)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["duration"] = time.perf_counter() - start
+            record["peak_rss_mb"] = peak_rss_mb()
+            self.add(stage, **record)
+
+    def summary(self) -> dict:
+        """ Итоги по каждому этапу (длительности параллельных этапов складываются) """
+
+        summary = {}
+        for record in self.records:
+            total = summary.setdefault(record["stage"], {
+                "count": 0,
+                "duration": 0.0,
+                "bytes_read": 0,
+                "bytes_written": 0,
+                "hits": 0,
+                "misses": 0
+            })
+            total["count"] += 1
+            total["duration"] += record.get("duration", 0.0)
+            total["bytes_read"] += record.get("bytes_read", 0)
+            total["bytes_written"] += record.get("bytes_written", 0)
+            if "hit" in record:
+                total["hits" if record["hit"] else "misses"] += 1
+
+        return summary
+
+    def save(self, save_dir: Path, **info) -> Path:
+        """ Записать build_report.json в save_dir (info - сведения о сборке) """
+
+        report = {
+            "started": datetime.fromtimestamp(self._started).isoformat(timespec="seconds"),
+            "duration": time.time() - self._started,
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_children_mb": peak_rss_mb(children=True),
+            **info,
+            "summary": self.summary(),
+            "stages": self.records
+        }
+
+        save_path = save_dir / self.filename
+        with open(save_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False, default=str)
+        return save_path
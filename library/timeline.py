@@ -0,0 +1,197 @@
+import json
+from pathlib import Path
+from typing import Optional
+
+from pydub import AudioSegment
+
+from library.audio import AudioAssembler
+from library.cache import get_index, get_temp_path, hash_data
+from library.fetch import get_song_id
+from library.report import BuildReport, file_size
+
+
+# Параметры склейки микса (входят в ключ кэша). Частота, каналы и разрядность
+# заданы заранее: микс пишется по ходу склейки, до того как известны все треки
+MIX = {"crossfade": 100, "silence": 2200, "format": "mp3", "frame_rate": 48000, "channels": 2, "sample_width": 2}
+
+
+def get_mix_entry(song: dict) -> dict:
+    """ Входные данные трека, от которых зависит микс """
+    return {
+        "audio": Path(song["audio"]).name,
+        "crop_start": song["crop_start"],
+        "duration": song["duration"]
+    }
+
+
+class Timeline:
+    """ План сборки плейлиста: для каждой строки ключ входных данных, mp4 и момент начала,
+    а также файл микса. Сохраняется рядом с playlist.mp4, чтобы следующая сборка
+    знала, что уже сделано.
+    """
+
+    filename = "timeline.json"
+
+    def __init__(self, mode: int, songs: Optional[list[dict]] = None, mix: Optional[str] = None):
+        self.mode = mode
+        self.songs = songs or []
+        self.mix = mix
+
+    @classmethod
+    def load(cls, save_dir: Path, mode: int) -> Optional["Timeline"]:
+        """ План прошлой сборки в save_dir или None, если его нет или он другого режима """
+
+        path = save_dir / cls.filename
+        if not path.exists():
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            # Испорченный план не мешает сборке, просто всё собирается заново
+            return None
+        if data.get("mode") != mode:
+            return None
+        return cls(mode, data["songs"], data["mix"])
+
+    @classmethod
+    def discard(cls, save_dir: Path) -> None:
+        """ Забыть план (например, пока playlist.mp4 перезаписывается) """
+        (save_dir / cls.filename).unlink(missing_ok=True)
+
+    def save(self, save_dir: Path) -> Path:
+        save_path = save_dir / self.filename
+        with open(save_path, "w", encoding="utf-8") as file:
+            json.dump({"mode": self.mode, "mix": self.mix, "songs": self.songs}, file, indent=2, ensure_ascii=False)
+        return save_path
+
+    def add(
+            self,
+            song: dict,
+            input_hash: str,
+            segment: Path,
+            start: int
+    ) -> None:
+        self.songs.append({
+            "url": song["url"],
+            "title": song["title"],
+            "input_hash": input_hash,
+            "segment": segment.name,
+            "start": start,
+            **get_mix_entry(song)
+        })
+
+    @property
+    def segments(self) -> list[str]:
+        return [song["segment"] for song in self.songs]
+
+    def changed_rows(self, previous: Optional["Timeline"]) -> list[int]:
+        """ Номера строк (с 1), которых не было в прошлой сборке """
+        known = {song["input_hash"] for song in previous.songs} if previous else set()
+        return [idx for idx, song in enumerate(self.songs, start=1) if song["input_hash"] not in known]
+
+    def same_output(self, previous: Optional["Timeline"]) -> bool:
+        """ Итоговое видео совпадает с прошлым (те же mp4 в том же порядке и тот же микс) """
+        return previous is not None and previous.segments == self.segments and previous.mix == self.mix
+
+
+class MixBuilder:
+    """ Общий звук плейлиста, который не собирается заново, если треки не изменились
+
+    Пока треки совпадают с прошлой сборкой, они не декодируются: если совпадут все,
+    берётся готовый микс из кэша. На первом расхождении склейка начинается с начала
+    и дальше идёт по мере готовности треков.
+    """
+
+    def __init__(
+            self,
+            cache_dir: Path,
+            silence: AudioSegment,
+            previous: Optional[Timeline] = None,
+            build_id: Optional[str] = None,
+            report: Optional[BuildReport] = None,
+            bitrate: Optional[str] = None
+    ):
+        self._cache_dir = cache_dir
+        self._bitrate = bitrate
+        self._silence = silence[:MIX["silence"]]
+        self._expected = [get_mix_entry(song) for song in previous.songs] if previous else []
+        self._build_id = build_id
+        self._report = report or BuildReport()
+
+        self._entries = []
+        self._deferred = []
+        self._assembler: Optional[AudioAssembler] = None
+        self._path = get_temp_path(cache_dir / f"mix.{MIX['format']}")
+
+    def __enter__(self) -> "MixBuilder":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is not None and self._assembler is not None:
+            self._assembler.abort()
+
+    def append(self, song: dict) -> None:
+        """ Добавить трек (нужны audio, crop_start и duration) """
+
+        entry = get_mix_entry(song)
+        idx = len(self._entries)
+        self._entries.append(entry)
+
+        if self._assembler is None and idx < len(self._expected) and entry == self._expected[idx]:
+            self._deferred.append(song)
+            return
+
+        self._start()
+        self._append(song)
+
+    def _start(self) -> None:
+        if self._assembler is not None:
+            return
+        self._assembler = AudioAssembler(
+            self._path,
+            format=MIX["format"],
+            bitrate=self._bitrate,
+            frame_rate=MIX["frame_rate"],
+            channels=MIX["channels"],
+            sample_width=MIX["sample_width"]
+        )
+        deferred, self._deferred = self._deferred, []
+        for song in deferred:
+            self._append(song)
+
+    def _append(self, song: dict) -> None:
+        with self._report.stage("audio_append", song=get_song_id(song["url"])) as record:
+            crop_start = song["crop_start"]
+            duration = song["duration"]
+            segment = AudioSegment.from_file(song["audio"])
+            segment = segment[(crop_start * 1000):((crop_start + duration) * 1000)]
+            self._assembler.append(segment, crossfade=MIX["crossfade"])
+            self._assembler.append(self._silence, crossfade=MIX["crossfade"])
+            record["bytes_read"] = file_size(Path(song["audio"]))
+
+    def close(self) -> Path:
+        """ Путь к миксу в папке кэша (готовый или только что собранный) """
+
+        index = get_index(self._cache_dir)
+        key = hash_data({"songs": self._entries, "mix": MIX, "bitrate": self._bitrate})
+        mix_name = f"mix_{key[:16]}.{MIX['format']}"
+
+        with self._report.stage("cache_lookup", mix=mix_name) as record:
+            mix_path = index.get(mix_name, build_id=self._build_id)
+            record["hit"] = mix_path is not None
+
+        if mix_path is not None:
+            if self._assembler is not None:
+                self._assembler.abort()
+            return mix_path
+
+        # Микс кодируется по ходу склейки, здесь дописывается только остаток
+        self._start()
+        with self._report.stage("export") as record:
+            self._assembler.close()
+            mix_path = self._path.replace(self._cache_dir / mix_name)
+            index.add(mix_path, duration=self._assembler.duration_seconds, input_hash=key, build_id=self._build_id)
+            record["bytes_written"] = file_size(mix_path)
+
+        return mix_path
@@ -1,10 +1,17 @@
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Optional
 
 from loguru import logger
 
+import dirs
+from cache_gc import prune_cache
+from library.cache import get_index
+from library.encoding import get_encoding
+from library.fetch import get_fetcher
 from library.files import YAMLFile
-from playlist_v1 import visualize_playlist as visualize_playlist_v1
+from playlist_v1 import CHUNK_SECONDS, visualize_playlist as visualize_playlist_v1
 from playlist_v2 import visualize_playlist as visualize_playlist_v2
 from song import visualize_song
 
@@ -12,10 +19,11 @@ from song import visualize_song
 logger.add("error.log", format="{time} {level} {message}", level="ERROR")
 
 
-@logger.catch
-def main():
+def run_job(config: dict, executor: Optional[ProcessPoolExecutor] = None) -> dict:
+    """ Выполнить одно задание (содержимое config.yml) и вернуть пути к результатам
 
-    config = YAMLFile(Path('config.yml')).read()
+    executor - готовый пул процессов для отрисовки треков v1 (например, пул демона).
+    """
 
     xlsx_file = Path(config["xlsx_file"])
     bg_file = Path(config["bg_file"]) if config["bg_file"] else None
@@ -25,34 +33,77 @@ def main():
     save_dir = Path(config["save_dir"])
     mode = config["mode"]
     example_frame = config["example_frame"]
+    workers = config.get("workers") or None
+    fetch_workers = config.get("fetch_workers") or 4
+    profile = config.get("profile") or False
+    incremental = config.get("incremental", True)
+    encoding = get_encoding(config.get("encoding"))
+    queue_size = config.get("queue_size") or 2
+    chunk_seconds = config.get("chunk_seconds") or CHUNK_SECONDS
+    fetcher = get_fetcher(Path(config["fetch_dir"]) if config.get("fetch_dir") else None)
 
     styles = YAMLFile(styles_file).read()
 
-    if mode == 1:
-        visualize_playlist_v1(
-            styles=styles,
-            xlsx_file=xlsx_file,
-            bg_file=bg_file,
-            save_dir=save_dir,
-            example_frame=example_frame
-        )
-    elif mode == 2:
-        visualize_playlist_v2(
-            styles=styles,
-            xlsx_file=xlsx_file,
-            img_file=img_file,
-            bg_file=bg_file,
-            save_dir=save_dir,
-            example_frame=example_frame
-        )
-    elif mode == 3:
-        visualize_song(
-            styles=styles,
-            mp3_file=mp3_file,
-            img_file=img_file,
-            save_dir=save_dir,
-            example_frame=example_frame
-        )
+    # Файлы кэша, которые использует сборка, не удаляются при очистке
+    index = get_index(dirs.cache)
+    with index.build() as build_id:
+
+        if mode == 1:
+            result = visualize_playlist_v1(
+                styles=styles,
+                xlsx_file=xlsx_file,
+                bg_file=bg_file,
+                save_dir=save_dir,
+                example_frame=example_frame,
+                workers=workers,
+                fetch_workers=fetch_workers,
+                queue_size=queue_size,
+                fetcher=fetcher,
+                build_id=build_id,
+                profile=profile,
+                incremental=incremental,
+                encoding=encoding,
+                executor=executor,
+                chunk_seconds=chunk_seconds
+            )
+        elif mode == 2:
+            result = visualize_playlist_v2(
+                styles=styles,
+                xlsx_file=xlsx_file,
+                img_file=img_file,
+                bg_file=bg_file,
+                save_dir=save_dir,
+                example_frame=example_frame,
+                workers=workers,
+                fetch_workers=fetch_workers,
+                queue_size=queue_size,
+                fetcher=fetcher,
+                build_id=build_id,
+                incremental=incremental,
+                encoding=encoding
+            )
+        elif mode == 3:
+            result = visualize_song(
+                styles=styles,
+                mp3_file=mp3_file,
+                img_file=img_file,
+                save_dir=save_dir,
+                example_frame=example_frame,
+                encoding=encoding
+            )
+        else:
+            raise Exception(f"Unknown mode: {mode}")
+
+    # Уложиться в бюджет кэша, если он задан
+    prune_cache(config)
+
+    return result
+
+
+@logger.catch
+def main():
+    config = YAMLFile(Path('config.yml')).read()
+    run_job(config)
 
 
 if __name__ == '__main__':
@@ -1,51 +1,157 @@
+import cProfile
+import math
 import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
 from time import strftime, gmtime
+from typing import Iterator, Optional
 
 from dotenv import load_dotenv
-# Подгружаем IMAGEIO_FFMPEG_EXE (обязательно перед moviepy)
-from library.utils import download_youtube_video, mp4_to_mp3
 
+# Подгружаем IMAGEIO_FFMPEG_EXE (обязательно до первого вызова ffmpeg)
 load_dotenv()
 
 import numpy as np
-from moviepy.editor import ImageClip, AudioFileClip, VideoFileClip, CompositeAudioClip, concatenate_videoclips
-from PIL import Image, ImageFilter, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 from pydub import AudioSegment
 
 import dirs
-from library.files import XLSXFile, Folder
-from library.process import run_as_process
+from library.blur import blur_region
+from library.cache import atomic_write, hash_data, hash_file, get_index
+from library.encoding import get_encoding, get_encoding_key, resolve_threads
+from library.fetch import Fetcher, YouTubeFetcher, fetch_song, get_song_id
+from library.ffmpeg import concat_videos, encode_overlay
+from library.files import get_table_file
+from library.fonts import load_font, get_glyph_atlas
+from library.pipeline import Stage, run_pipeline
+from library.process import TaskError, call_with_traceback, default_workers, start_executor
+from library.report import BuildReport, file_size, peak_rss_mb
+from library.timeline import MixBuilder, Timeline
 
 
-def get_frame(
-        styles: dict,
-        bg_image: Image,
-        main_rect: tuple,
-        current_sec: int,
-        duration: int
-) -> Image:
-    """ Получить один кадр для конкретной секунды """
+# Версия отрисовки кадров: увеличивается при изменении фона, get_frame / draw_timebar / FrameRenderer
+# или кодирования трека, чтобы ранее сделанные mp4 в кэше не использовались
+RENDER_VERSION = 3
 
-    frame = bg_image.copy()
-    draw = ImageDraw.Draw(frame)
+# Частота кадров mp4 по умолчанию (если в стилях не задан v1.fps):
+# время на полоске меняется раз в секунду
+FPS = 1
 
-    # =============== #
-    # Полоска времени #
-    # =============== #
+# Длительность части (в секундах), на которые делится длинный трек,
+# чтобы его отрисовывали и кодировали несколько процессов одновременно
+CHUNK_SECONDS = 120
+
+
+def get_fps(styles: dict) -> int:
+    """ Частота кадров mp4 из стилей """
+    return int(styles["v1"].get("fps") or FPS)
+
+
+def get_render_key(
+        styles: dict,
+        song_id: str,
+        title: str,
+        bg_file: Path,
+        crop_start: int,
+        crop_end: int,
+        silent: bool,
+        encoding: dict
+) -> str:
+    """ Ключ кэша mp4 трека: хэш всех входных данных, влияющих на результат """
+    return hash_data({
+        "version": RENDER_VERSION,
+        "styles": {
+            "width": styles["width"],
+            "height": styles["height"],
+            # Частота кадров учитывается отдельно, чтобы ключи mp4 с FPS = 1 не изменились
+            "v1": {key: value for key, value in styles["v1"].items() if key != "fps"}
+        },
+        "song_id": song_id,
+        "title": title,
+        "bg_file": hash_file(bg_file),
+        "crop_start": crop_start,
+        "crop_end": crop_end,
+        "silent": silent,
+        "fps": get_fps(styles),
+        "encoding": get_encoding_key(encoding)
+    })
+
+
+def get_timebar_rect(styles: dict, main_rect: tuple) -> tuple:
+    """ Получить координаты полоски времени """
 
     mrw = styles["v1"]["main_rect"]["width"]
     tw = styles["v1"]["timebar"]["width"]
     th = styles["v1"]["timebar"]["height"]
     tmb = styles["v1"]["timebar"]["margin_bottom"]
 
-    rect_timebar = (
+    return (
         main_rect[0] + (mrw - tw) // 2,
         main_rect[3] - tmb - th,
         main_rect[0] + (mrw - tw) // 2 + tw,
         main_rect[3] - tmb
     )
 
+
+def get_timebar_region(styles: dict, rect_timebar: tuple) -> tuple:
+    """ Получить область кадра, которая меняется от секунды к секунде """
+
+    w = styles["width"]
+    h = styles["height"]
+    th = styles["v1"]["timebar"]["height"]
+    cs = styles["v1"]["timebar"]["circle_size"]
+    border_width = styles["v1"]["timebar"]["border_width"]
+
+    # Полоска и кружочек в крайних положениях
+    x0 = rect_timebar[0] - (cs // 2) - border_width
+    y0 = min(rect_timebar[1], rect_timebar[1] - (cs // 2) + (th // 2)) - border_width
+    x1 = rect_timebar[2] + (cs // 2) + border_width
+    y1 = max(rect_timebar[3], rect_timebar[1] + (cs // 2) + (th // 2)) + border_width
+
+    # Время слева и справа с запасом на самую широкую подпись
+    font_name = styles["v1"]["time"]["font_name"]
+    font_size = styles["v1"]["time"]["font_size"]
+    shift_x = styles["v1"]["time"]["shift_x"]
+    shift_y = styles["v1"]["time"]["shift_y"]
+    stroke_width = styles["v1"]["time"]["stroke_width"]
+
+    font = load_font(dirs.fonts / font_name, font_size)
+    max_width = max(font.getlength(f"{d}{d}:{d}{d}") for d in "0123456789")
+    bbox = font.getbbox("0123456789:", stroke_width=stroke_width)
+    padding = font_size // 2
+
+    x0 = min(x0, int(rect_timebar[0] - shift_x - max_width) + bbox[0] - padding)
+    y0 = min(y0, rect_timebar[1] - shift_y + bbox[1] - padding)
+    x1 = max(x1, int(rect_timebar[2] + shift_x + max_width) + stroke_width + padding)
+    y1 = max(y1, rect_timebar[1] - shift_y + bbox[3] + padding)
+
+    # Границы чётные: область накладывается на кадр в yuv420p, где цвет задаётся на квадрат 2x2
+    x0, y0 = max(0, x0 - x0 % 2), max(0, y0 - y0 % 2)
+    x1, y1 = min(w, x1 + 1 + (x1 + 1) % 2), min(h, y1 + 1 + (y1 + 1) % 2)
+    return x0, y0, x1, y1
+
+
+def draw_timebar(
+        image: Image,
+        styles: dict,
+        rect_timebar: tuple,
+        current_sec: int,
+        duration: int
+) -> None:
+    """ Нарисовать полоску времени, кружочек и время """
+
+    draw = ImageDraw.Draw(image)
+
+    # =============== #
+    # Полоска времени #
+    # =============== #
+
+    tw = styles["v1"]["timebar"]["width"]
+    th = styles["v1"]["timebar"]["height"]
+
     # Заполненная часть
 
     color = styles["v1"]["timebar"]["color_filled"]
@@ -104,48 +210,291 @@ def get_frame(
     stroke_color = styles["v1"]["time"]["stroke_color"]
     stroke_width = styles["v1"]["time"]["stroke_width"]
 
-    font_path = str(dirs.fonts / font_name)
-    font = ImageFont.truetype(font_path, font_size)
+    # Время выводится готовыми символами из атласа, а не отрисовкой текста
+    atlas = get_glyph_atlas(dirs.fonts / font_name, font_size, color, stroke_color, stroke_width)
 
     # Слева
     text = strftime("%M:%S", gmtime(current_sec))
-    text_width = draw.textlength(text, font=font)
+    text_width = atlas.length(text)
     x = rect_timebar[0] - text_width - shift_x
     y = rect_timebar[1] - shift_y
-    draw.text((x, y), text, font=font, fill=color, stroke_fill=stroke_color, stroke_width=stroke_width)
+    atlas.draw(image, (x, y), text)
 
     # Справа
     text = strftime("%M:%S", gmtime(duration))
     x = rect_timebar[2] + shift_x
     y = rect_timebar[1] - shift_y
-    draw.text((x, y), text, font=font, fill=color, stroke_fill=stroke_color, stroke_width=stroke_width)
+    atlas.draw(image, (x, y), text)
+
+
+def get_frame(
+        styles: dict,
+        bg_image: Image,
+        main_rect: tuple,
+        current_sec: int,
+        duration: int
+) -> Image:
+    """ Получить один кадр для конкретной секунды """
 
+    frame = bg_image.copy()
+    rect_timebar = get_timebar_rect(styles, main_rect)
+    draw_timebar(frame, styles, rect_timebar, current_sec, duration)
     return frame
 
 
-def visualize_song(
-        styles: dict,
-        url: str,
-        title: str,
-        bg_file: Path,
-        crop_start: int = 0,
-        crop_end: int = 0,
-        save_dir: Path = Path.cwd(),
-        silent: bool = False,
-        example_frame: bool = False
-) -> dict[str, Path]:
-    """ Получить mp4 для одного трека или пример кадра """
+class FrameRenderer:
+    """ Кадры трека, в которых перерисовывается только область полоски времени
 
-    # ========================================= #
-    # Фон, который не меняется от кадра к кадру #
-    # ========================================= #
+    Полоска, кружочек и время собираются в массивах NumPy сразу для блока кадров
+    из заготовок, нарисованных PIL один раз: заполненной и незаполненной полосок
+    и спрайта кружочка. Результат совпадает с draw_timebar до пикселя.
+
+    При fps > 1 полоска заполняется плавно (между секундами). Кадры, в которых
+    полоска и время не изменились, не рисуются и не копируются заново, поэтому
+    время отрисовки зависит от числа изменений, а не от числа кадров.
+    """
+
+    # Сколько различных областей собирается за раз
+    batch_size = 32
+
+    def __init__(self, styles: dict, bg_image: Image, main_rect: tuple, duration: int, fps: int = FPS):
+
+        self._duration = duration
+        self._fps = fps
+        self._last_frame = duration * fps
+
+        rect_timebar = get_timebar_rect(styles, main_rect)
+        self._region = get_timebar_region(styles, rect_timebar)
+        x0, y0, _, _ = self._region
+
+        # Статичный фон собирается один раз, дальше меняется только область
+        self._frame = np.array(bg_image.convert("RGB"))
+        self._bg_region = np.array(bg_image.convert("RGB").crop(self._region))
+        self._rect_timebar = (
+            rect_timebar[0] - x0,
+            rect_timebar[1] - y0,
+            rect_timebar[2] - x0,
+            rect_timebar[3] - y0
+        )
+
+        timebar = styles["v1"]["timebar"]
+        self._tw = timebar["width"]
+        self._border_width = timebar["border_width"]
+        th = timebar["height"]
+
+        # Полоска целиком заполненная и целиком незаполненная, а также столбец рамки.
+        # Прямоугольники непрозрачные, поэтому от фона полоски не зависят.
+        strips = []
+        for color in (timebar["color_filled"], timebar["color_empty"]):
+            strip = Image.new("RGB", (self._tw + 1, th + 1))
+            ImageDraw.Draw(strip).rectangle(
+                (0, 0, self._tw, th),
+                fill=color,
+                outline=timebar["border_color"],
+                width=self._border_width
+            )
+            strips.append(np.asarray(strip))
+        self._filled_strip, self._empty_strip = strips
+        self._border_column = self._filled_strip[:, :1]
+
+        # Спрайт кружочка: цвета и маска нарисованных пикселей
+        cs = timebar["circle_size"]
+        size = 2 * (cs // 2) + 1
+        sprite = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+        ImageDraw.Draw(sprite).ellipse(
+            (0, 0, size - 1, size - 1),
+            fill=timebar["color_filled"],
+            outline=timebar["border_color"],
+            width=self._border_width
+        )
+        sprite = np.asarray(sprite)
+        self._circle_ys, self._circle_xs = np.nonzero(sprite[:, :, 3])
+        self._circle_colors = sprite[self._circle_ys, self._circle_xs, :3]
+        self._circle_offset = (-(cs // 2), -(cs // 2) + (th // 2))
+
+        # Время
+        time_styles = styles["v1"]["time"]
+        self._atlas = get_glyph_atlas(
+            dirs.fonts / time_styles["font_name"],
+            time_styles["font_size"],
+            time_styles["color"],
+            time_styles["stroke_color"],
+            time_styles["stroke_width"]
+        )
+        self._shift_x = time_styles["shift_x"]
+        self._shift_y = time_styles["shift_y"]
+
+        # Время справа не меняется: если оно не касается полоски и кружочка,
+        # оно рисуется на фоне один раз (см. render_block)
+        rx0, ry0, rx2, ry1 = self._rect_timebar
+        self._right = strftime("%M:%S", gmtime(duration))
+        self._right_xy = (rx2 + self._shift_x, ry0 - self._shift_y)
+        self._right_bbox = self._atlas.bbox(self._right_xy, self._right)
+        bar_bbox = (
+            min(rx0, rx0 + self._circle_offset[0]),
+            min(ry0, ry0 + self._circle_offset[1]),
+            max(rx2 + 1, rx2 + self._circle_offset[0] + size),
+            max(ry1 + 1, ry0 + self._circle_offset[1] + size)
+        )
+        self._bg_with_right = None
+        if not _intersects(self._right_bbox, bar_bbox):
+            self._bg_with_right = self._bg_region.copy()
+            self._atlas.draw_arrays(self._bg_with_right[None], [self._right_xy], [self._right])
+
+        self._patches = None
+        self._index = None
+        self._block_start = 0
+        self._shown = None
+
+    @property
+    def region(self) -> tuple:
+        return self._region
+
+    def get_select_expr(self, start: int, end: int) -> str:
+        """ Выражение для фильтра select ffmpeg, который получает кадры [start, end) по порядку:
+        оставить первый и последний кадр и кадры, в которых область отличается от предыдущего
+
+        Условие то же, что у render_block: изменилась заполненная часть или секунда.
+        """
+        frame = f"(n+{start})"
+        return (
+            f"eq(n,0)+eq(n,{end - start - 1})+lte({frame},{self._last_frame})*("
+            f"not(eq(floor({self._tw}*{frame}/{self._last_frame}),floor({self._tw}*({frame}-1)/{self._last_frame})))"
+            f"+not(mod({frame},{self._fps})))"
+        )
+
+    def render_block(self, frames: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """ Области полоски времени для нескольких кадров сразу
+
+        Возвращает различные области (N x высота x ширина x 3) и для каждого кадра
+        номер его области: кадры с одинаковой полоской и временем рисуются один раз.
+        Областей не больше batch_size, поэтому номера могут быть не у всех кадров,
+        а только у первых.
+        """
+
+        x0, y0, x2, y1 = self._rect_timebar
+        tw = self._tw
+        bw = self._border_width
+
+        # Заполненная часть считается по доле кадров (между секундами - плавно),
+        # время - по целым секундам
+        frames = np.minimum(frames, self._last_frame)
+        filled_width = tw * frames // self._last_frame
+        seconds = frames // self._fps
+        # Полоска и время от кадра к кадру не убывают, поэтому номера областей идут по порядку
+        _, first, index = np.unique(filled_width * (self._duration + 1) + seconds, return_index=True, return_inverse=True)
+        first = first[:self.batch_size]
+        index = index[:np.searchsorted(index, self.batch_size)]
+        filled_width = filled_width[first]
+        seconds = seconds[first]
+
+        lefts = [strftime("%M:%S", gmtime(int(current_sec))) for current_sec in seconds]
+        left_xys = [(x0 - self._atlas.length(left) - self._shift_x, y0 - self._shift_y) for left in lefts]
+
+        # Фон с готовым временем справа подходит, если время слева его тоже не касается
+        baked = self._bg_with_right is not None and not any(
+            _intersects(self._right_bbox, self._atlas.bbox(xy, left)) for xy, left in zip(left_xys, lefts)
+        )
+        block = np.repeat((self._bg_with_right if baked else self._bg_region)[None], len(seconds), axis=0)
+
+        # Полоска: слева от filled_width заполненная часть, справа незаполненная,
+        # на стыке правая рамка заполненного и левая рамка незаполненного прямоугольников
+        for bar, filled in zip(block[:, y0:y1 + 1, x0:x2 + 1], filled_width):
+            bar[:, :filled] = self._filled_strip[:, :filled]
+            bar[:, filled:] = self._empty_strip[:, filled:]
+            bar[:, max(0, filled - bw + 1):filled + bw] = self._border_column
+        filled_width = filled_width[:, None]
+
+        # Кружочек поверх полоски (пиксели за краем области отбрасываются)
+        rows = np.broadcast_to(y0 + self._circle_offset[1] + self._circle_ys, (len(seconds), len(self._circle_ys)))
+        cols = x0 + filled_width + self._circle_offset[0] + self._circle_xs
+        patches = np.broadcast_to(np.arange(len(seconds))[:, None], rows.shape)
+        colors = np.broadcast_to(self._circle_colors, (*rows.shape, 3))
+        height, width = block.shape[1:3]
+        visible = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        block[patches[visible], rows[visible], cols[visible]] = colors[visible]
+
+        # Время слева и справа
+        self._atlas.draw_arrays(block, left_xys, lefts)
+        if not baked:
+            self._atlas.draw_arrays(block, [self._right_xy] * len(seconds), [self._right] * len(seconds))
+
+        return block, index
+
+    def _get_patch(self, frame: int) -> int:
+        """ Номер области кадра в текущем блоке (блоки собираются по batch_size секунд подряд) """
+
+        frame = min(frame, self._last_frame)
+        if self._patches is None or not 0 <= frame - self._block_start < len(self._index):
+            frames = np.arange(frame, min(frame + self.batch_size * self._fps, self._last_frame + 1))
+            self._patches, self._index = self.render_block(frames)
+            self._block_start = frame
+            self._shown = None
+        return self._index[frame - self._block_start]
+
+    def get_region(self, frame: int) -> np.ndarray:
+        """ Область полоски времени (region) кадра по номеру, при fps = 1 - по секунде;
+        кадры после конца трека показывают заполненную полоску
+        """
+        patch = self._get_patch(frame)
+        return self._patches[patch]
+
+    def get_frame(self, frame: int) -> np.ndarray:
+        """ Получить кадр по номеру (см. get_region)
+
+        Буфер переиспользуется, изменять его нельзя: область полоски копируется
+        в него, только если отличается от предыдущего кадра.
+        """
+
+        patch = self._get_patch(frame)
+        if patch != self._shown:
+            x0, y0, x1, y1 = self._region
+            self._frame[y0:y1, x0:x1] = self._patches[patch]
+            self._shown = patch
+        return self._frame
+
+
+def _intersects(a: tuple, b: tuple) -> bool:
+    """ Пересекаются ли прямоугольники (x0, y0, x1, y1 - не включая x1 и y1) """
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def get_main_rect(styles: dict) -> tuple:
+    """ Получить координаты прямоугольника с названием и полоской времени """
+
+    w = styles["width"]
+    h = styles["height"]
+    rect_w = styles["v1"]["main_rect"]["width"]
+    rect_h = styles["v1"]["main_rect"]["height"]
+    rect_mb = styles["v1"]["main_rect"]["margin_bottom"]
+    rect_ml = (w - rect_w) // 2
+
+    return rect_ml, h - rect_mb - rect_h, rect_ml + rect_w, h - rect_mb
+
+
+def get_base_key(styles: dict, bg_file: Path) -> str:
+    """ Ключ кэша фона без названия: хэш картинки и стилей рамки и прямоугольника """
+    return hash_data({
+        "version": RENDER_VERSION,
+        "size": (styles["width"], styles["height"]),
+        "blur_radius": styles["v1"]["blur_radius"],
+        "main_border": styles["v1"]["main_border"],
+        "main_rect": styles["v1"]["main_rect"],
+        "bg_file": hash_file(bg_file)
+    })
+
+
+def compose_base_layer(styles: dict, bg_file: Path) -> Image:
+    """ Нарисовать фон без названия: картинка с размытыми рамкой и прямоугольником """
 
     w = styles["width"]
     h = styles["height"]
     blur_radius = styles["v1"]["blur_radius"]
 
     bg_image = Image.open(bg_file)
-    bg_blur = Image.open(bg_file).filter(ImageFilter.GaussianBlur(radius=blur_radius))
+    bg_source = bg_image.copy()
+
+    # Размываются только области рамки и прямоугольника, а не весь фон
 
     # Рамка
 
@@ -157,22 +506,67 @@ def visualize_song(
     rect_right = (w - bm - bw, bm, w - bm, h - bm)
     rect_lower = (bm, h - bm - bw, w - bm, h - bm)
 
-    bg_image.paste(bg_blur.crop(rect_left), rect_left)
-    bg_image.paste(bg_blur.crop(rect_upper), rect_upper)
-    bg_image.paste(bg_blur.crop(rect_right), rect_right)
-    bg_image.paste(bg_blur.crop(rect_lower), rect_lower)
+    bg_image.paste(blur_region(bg_source, rect_left, blur_radius), rect_left)
+    bg_image.paste(blur_region(bg_source, rect_upper, blur_radius), rect_upper)
+    bg_image.paste(blur_region(bg_source, rect_right, blur_radius), rect_right)
+    bg_image.paste(blur_region(bg_source, rect_lower, blur_radius), rect_lower)
 
     # Прямоугольник
 
-    rect_w = styles["v1"]["main_rect"]["width"]
-    rect_h = styles["v1"]["main_rect"]["height"]
-    rect_mb = styles["v1"]["main_rect"]["margin_bottom"]
-    rect_ml = (w - rect_w) // 2
+    main_rect = get_main_rect(styles)
+    bg_image.paste(blur_region(bg_source, main_rect, blur_radius), main_rect)
+
+    return bg_image
+
+
+# Фоны, недавно загруженные процессом (долгоживущий демон не должен копить их все:
+# каждый занимает несколько мегабайт, а на диске они и так есть в кэше)
+_base_layers = OrderedDict()
+_base_layers_lock = threading.Lock()
+BASE_LAYERS_IN_MEMORY = 4
 
-    main_rect = (rect_ml, h - rect_mb - rect_h, rect_ml + rect_w, h - rect_mb)
-    bg_image.paste(bg_blur.crop(main_rect), main_rect)
 
-    # Заголовок
+def get_base_layer(styles: dict, bg_file: Path, build_id: Optional[str] = None) -> Image:
+    """ Фон без названия, общий для всех треков плейлиста
+
+    Рисуется один раз для пары картинка-стили и хранится в кэше как png,
+    а в процессе, который уже его загрузил, - в памяти (BASE_LAYERS_IN_MEMORY последних).
+    """
+
+    key = get_base_key(styles, bg_file)
+    with _base_layers_lock:
+        bg_image = _base_layers.get(key)
+        if bg_image is not None:
+            _base_layers.move_to_end(key)
+    if bg_image is not None:
+        return bg_image.copy()
+
+    png_name = f"v1bg_{key[:16]}.png"
+    index = get_index(dirs.cache)
+    png_path = index.get(png_name, build_id=build_id)
+    if png_path is not None:
+        with Image.open(png_path) as image:
+            bg_image = image.copy()
+    else:
+        bg_image = compose_base_layer(styles, bg_file)
+        # Запись через временный файл, чтобы другой процесс не прочитал недописанную картинку
+        with atomic_write(dirs.cache / png_name) as tmp_path:
+            bg_image.save(str(tmp_path), format="PNG")
+        png_path = dirs.cache / png_name
+        index.add(png_path, input_hash=key, build_id=build_id)
+
+    with _base_layers_lock:
+        _base_layers[key] = bg_image
+        if len(_base_layers) > BASE_LAYERS_IN_MEMORY:
+            _base_layers.popitem(last=False)
+    return bg_image.copy()
+
+
+def get_title_layer(styles: dict, bg_file: Path, title: str, build_id: Optional[str] = None) -> Image:
+    """ Фон трека: общий фон с названием в прямоугольнике """
+
+    bg_image = get_base_layer(styles, bg_file, build_id=build_id)
+    main_rect = get_main_rect(styles)
 
     font_name = styles["v1"]["title"]["font_name"]
     font_size = styles["v1"]["title"]["font_size"]
@@ -181,80 +575,314 @@ def visualize_song(
     stroke_width = styles["v1"]["title"]["stroke_width"]
 
     draw = ImageDraw.Draw(bg_image)
-    font_path = str(dirs.fonts / font_name)
-    font = ImageFont.truetype(font_path, font_size)
+    font = load_font(dirs.fonts / font_name, font_size)
     text_width = draw.textlength(title, font=font)
-    x = main_rect[0] + ((rect_w - text_width) // 2)
+    x = main_rect[0] + ((main_rect[2] - main_rect[0] - text_width) // 2)
     y = main_rect[1] + 10
     draw.text((x, y), title, font=font, fill=color, stroke_fill=stroke_color, stroke_width=stroke_width)
 
+    return bg_image
+
+
+def get_chunks(duration: int, chunk_seconds: int = CHUNK_SECONDS) -> list[tuple[int, int]]:
+    """ Части [start, end) видео трека (длительность duration плюс две секунды в конце)
+
+    Трек короче двух частей не делится. Границы частей - целые секунды, то есть
+    границы кадров при любой целой частоте, поэтому части склеиваются без сдвига времени.
+    """
+
+    total = duration + 2
+    if total < 2 * chunk_seconds:
+        return [(0, total)]
+
+    count = math.ceil(total / chunk_seconds)
+    bounds = [total * idx // count for idx in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def render_chunk(
+        styles: dict,
+        song_id: str,
+        title: str,
+        bg_file: Path,
+        duration: int,
+        start: int,
+        end: int,
+        save_path: Path,
+        audio_path: Optional[Path] = None,
+        build_id: Optional[str] = None,
+        profile_dir: Optional[Path] = None,
+        encoding: Optional[dict] = None
+) -> list[dict]:
+    """ Отрисовать и закодировать секунды [start, end) видео трека в save_path
+
+    Кадр зависит только от текущей секунды и длительности трека, поэтому
+    части можно делать независимо в разных процессах и затем склеивать.
+    audio_path - звук (только для трека целиком). Возвращает замеры этапов.
+    """
+
+    encoding = encoding or get_encoding()
+    report = BuildReport()
+    fields = {"song": song_id} if (start, end) == (0, duration + 2) else {"song": song_id, "chunk": start}
+
+    # ffmpeg накладывает область полоски на неподвижный фон, поэтому
+    # из Python в него уходит только область каждого кадра, которая
+    # рисуется по запросу (в памяти одновременно один блок областей).
+    # Кодируются только кадры, в которых полоска сдвинулась или сменилось
+    # время: кодировщик тратит на кадр одно и то же время, даже если он не изменился.
+    # Последние две секунды показывают заполненную полоску.
+
+    # Фон, который не меняется от кадра к кадру
+    with report.stage("background", **fields):
+        bg_image = get_title_layer(styles, bg_file, title, build_id=build_id)
+    fps = get_fps(styles)
+    renderer = FrameRenderer(styles, bg_image, get_main_rect(styles), duration, fps=fps)
+
+    # Время отрисовки копится отдельно от времени кодирования,
+    # профилируется (если нужно) только отрисовка
+    render_time = [0.0, 0]
+    profiler = cProfile.Profile() if profile_dir else None
+
+    def get_regions() -> Iterator[np.ndarray]:
+        for frame in range(start * fps, end * fps):
+            begin = time.perf_counter()
+            if profiler:
+                profiler.enable()
+            region = renderer.get_region(frame)
+            if profiler:
+                profiler.disable()
+            render_time[0] += time.perf_counter() - begin
+            render_time[1] += 1
+            yield region
+
+    begin = time.perf_counter()
+    with get_index(dirs.cache).scratch(build_id) as scratch:
+        # Фон передаётся без сжатия: его всё равно декодируют один раз
+        png_path = scratch / "background.png"
+        bg_image.save(str(png_path), format="PNG", compress_level=0)
+        encode_overlay(
+            png_path,
+            get_regions(),
+            renderer.region,
+            save_path,
+            duration=end - start,
+            fps=fps,
+            select=renderer.get_select_expr(start * fps, end * fps),
+            audio=audio_path,
+            audio_bitrate=encoding["audio_bitrate"],
+            encoding=encoding
+        )
+
+    # Кадры рисуются внутри кодирования, поэтому их время вычитается из него
+    report.add(
+        "encode",
+        **fields,
+        duration=time.perf_counter() - begin - render_time[0],
+        bytes_written=file_size(save_path),
+        peak_rss_mb=peak_rss_mb()
+    )
+    report.add("frame_render", **fields, duration=render_time[0], frames=render_time[1])
+
+    if profiler:
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        profile_name = song_id if "chunk" not in fields else f"{song_id}_{start:06d}"
+        profiler.dump_stats(str(profile_dir / f"{profile_name}.prof"))
+
+    return report.records
+
+
+def render_song(
+        styles: dict,
+        song_id: str,
+        title: str,
+        bg_file: Path,
+        audio_path: Path,
+        duration: int,
+        save_path: Path,
+        silent: bool = False,
+        build_id: Optional[str] = None,
+        profile_dir: Optional[Path] = None,
+        encoding: Optional[dict] = None,
+        report: Optional[BuildReport] = None,
+        executor: Optional[Executor] = None,
+        chunk_seconds: int = CHUNK_SECONDS
+) -> Path:
+    """ Отрисовать и закодировать mp4 трека в save_path (замеры этапов пишутся в report)
+
+    С executor трек делается в его процессах, длинный трек - по частям
+    (см. get_chunks) одновременно, после чего части склеиваются без перекодирования.
+    """
+
+    encoding = encoding or get_encoding()
+    report = report or BuildReport()
+    chunks = get_chunks(duration, chunk_seconds) if executor else [(0, duration + 2)]
+    # Части кодируются одновременно, поэтому "auto" делит ядра между ними
+    encoding = resolve_threads(encoding, jobs=len(chunks))
+    kwargs = dict(
+        styles=styles,
+        song_id=song_id,
+        title=title,
+        bg_file=bg_file,
+        duration=duration,
+        build_id=build_id,
+        profile_dir=profile_dir,
+        encoding=encoding
+    )
+
+    # mp4 появляется в кэше под своим именем, только когда дописан целиком
+    if len(chunks) == 1:
+        with atomic_write(save_path) as tmp_path:
+            kwargs.update(start=0, end=duration + 2, save_path=tmp_path, audio_path=None if silent else audio_path)
+            if executor:
+                stages = executor.submit(call_with_traceback, render_chunk, kwargs).result()
+            else:
+                stages = render_chunk(**kwargs)
+        report.extend(stages)
+        return save_path
+
+    # Каждая часть начинается с ключевого кадра, поэтому склейка без перекодирования
+    # даёт то же видео, что и кодирование целиком. Звук добавляется при склейке.
+    with get_index(dirs.cache).scratch(build_id) as scratch:
+        paths = [scratch / f"{start:06d}.mp4" for start, _ in chunks]
+        futures = [
+            executor.submit(call_with_traceback, render_chunk, {**kwargs, "start": start, "end": end, "save_path": path})
+            for (start, end), path in zip(chunks, paths)
+        ]
+        try:
+            for future in futures:
+                report.extend(future.result())
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+        with report.stage("concat", song=song_id, chunks=len(chunks)) as record:
+            with atomic_write(save_path) as tmp_path:
+                concat_videos(
+                    paths,
+                    tmp_path,
+                    audio=None if silent else audio_path,
+                    audio_bitrate=encoding["audio_bitrate"],
+                    duration=duration + 2
+                )
+            record["bytes_read"] = sum(file_size(path) for path in paths)
+            record["bytes_written"] = file_size(save_path)
+
+    return save_path
+
+
+def visualize_song(
+        styles: dict,
+        url: str,
+        title: str,
+        bg_file: Path,
+        crop_start: int = 0,
+        crop_end: int = 0,
+        save_dir: Path = Path.cwd(),
+        silent: bool = False,
+        example_frame: bool = False,
+        audio: Optional[Path] = None,
+        fetcher: Optional[Fetcher] = None,
+        build_id: Optional[str] = None,
+        profile_dir: Optional[Path] = None,
+        encoding: Optional[dict] = None,
+        executor: Optional[Executor] = None,
+        chunk_seconds: int = CHUNK_SECONDS
+) -> dict:
+    """ Получить mp4 для одного трека или пример кадра
+
+    audio - уже полученный звук трека в папке кэша (иначе он ищется там или скачивается через
+    fetcher, по умолчанию с YouTube),
+    build_id - сборка, за которой закрепляются файлы кэша (см. CacheIndex.build),
+    profile_dir - папка для профиля отрисовки кадров ({song_id}.prof, cProfile),
+    encoding - настройки кодирования (см. library.encoding),
+    executor - пул процессов для отрисовки (длинный трек делится на части
+    по chunk_seconds секунд, которые делаются одновременно).
+    Замеры этапов отдаются в "stages" (см. BuildReport).
+    """
+
+    report = BuildReport()
+
     # ========================================= #
     # Отдать пример кадра, если нужен только он #
     # ========================================= #
 
     if example_frame:
-        frame = get_frame(styles, bg_image, main_rect, current_sec=13, duration=124)
+        bg_image = get_title_layer(styles, bg_file, title, build_id=build_id)
+        frame = get_frame(styles, bg_image, get_main_rect(styles), current_sec=13, duration=124)
         save_path = save_dir / "frame.jpg"
         frame.save(str(save_path), format="JPEG", subsampling=0, quality=100)
         return {"jpg": save_path}
 
-    # =========== #
-    # Скачать mp3 #
-    # =========== #
+    # ============ #
+    # Скачать звук #
+    # ============ #
 
-    song_id = url.replace("https://youtube.com/watch?v=", "")
+    song_id = get_song_id(url)
 
-    # Ищем в ранее скачанных
-    mp3s = Folder(dirs.cache).find_by_name(f"{song_id}.mp3")
-    if mp3s:
-        mp3_path = mp3s[0]
-    else:
-        # Скачиваем видео, делаем аудио
-        mp4 = download_youtube_video(url, save_dir=dirs.cache, filename=f"{song_id}.mp4")
-        mp3_path = mp4_to_mp3(mp4, remove_src=True)
+    # Ищем в ранее скачанных, иначе скачиваем
+    audio_path = audio or fetch_song(url, dirs.cache, fetcher or YouTubeFetcher(), build_id=build_id, report=report)
+    index = get_index(dirs.cache)
 
     # =========== #
     # Сделать mp4 #
     # =========== #
 
-    # Ищем в ранее сделанных
-    mp4s = Folder(dirs.cache).find_by_name(f"{song_id}.mp4")
-    if mp4s:
-        mp4_path = mp4s[0]
-    else:
-        # Делаем кадр для каждой секунды
-
-        audio_clip = AudioFileClip(str(mp3_path))
-        duration = int(audio_clip.duration) - crop_end - crop_start
-
-        frames = [get_frame(styles, bg_image, main_rect, sec, duration) for sec in range(duration)]
-        frames.append(get_frame(styles, bg_image, main_rect, duration, duration))
-        frames.append(get_frame(styles, bg_image, main_rect, duration, duration))
-
-        for i in range(len(frames)):
-            frames[i] = ImageClip(np.array(frames[i])).set_duration(1)
-
-        video_clip = concatenate_videoclips(frames, method="compose")
-        if not silent:
-            audio_clip = AudioFileClip(str(mp3_path))
-            video_clip.audio = CompositeAudioClip([audio_clip])
-
-        mp4_path = dirs.cache / f"{song_id}.mp4"
-        video_clip.write_videofile(str(mp4_path), threads=8, fps=1)
-
-    # ================================== #
-    # Сохранить mp3 и mp4 куда требуется #
-    # ================================== #
-
-    mp3_save_path = save_dir / f"{song_id}.mp3"
-    if mp3_save_path != mp3_path:
-        shutil.copy(mp3_path, mp3_save_path)
-
-    mp4_save_path = save_dir / f"{song_id}.mp4"
+    # Длительность берётся из заголовка файла (и запоминается в индексе кэша)
+    with report.stage("probe", song=song_id):
+        duration = int(index.probe(audio_path)["duration"]) - crop_end - crop_start
+
+    # Ищем в ранее сделанных с теми же входными данными
+    encoding = encoding or get_encoding()
+    render_key = get_render_key(styles, song_id, title, bg_file, crop_start, crop_end, silent, encoding)
+    mp4_name = f"{song_id}_{render_key[:16]}.mp4"
+    with report.stage("cache_lookup", song=song_id) as record:
+        mp4_path = index.get(mp4_name, build_id=build_id)
+        record["hit"] = mp4_path is not None
+    if mp4_path is None:
+        # Один и тот же mp4, нужный нескольким сборкам сразу, делается один раз:
+        # остальные ждут блокировку и находят его в кэше
+        with index.lock(mp4_name):
+            mp4_path = index.get(mp4_name, build_id=build_id, count=False)
+            if mp4_path is None:
+                mp4_path = render_song(
+                    styles=styles,
+                    song_id=song_id,
+                    title=title,
+                    bg_file=bg_file,
+                    audio_path=audio_path,
+                    duration=duration,
+                    save_path=dirs.cache / mp4_name,
+                    silent=silent,
+                    build_id=build_id,
+                    profile_dir=profile_dir,
+                    encoding=encoding,
+                    report=report,
+                    executor=executor,
+                    chunk_seconds=chunk_seconds
+                )
+                index.add(mp4_path, duration=duration + 2, input_hash=render_key, build_id=build_id)
+
+    # =================================== #
+    # Сохранить звук и mp4 куда требуется #
+    # =================================== #
+
+    # Звук сохраняется в исходном формате (m4a, webm или mp3 из старого кэша)
+    audio_save_path = save_dir / audio_path.name
+    if audio_save_path != audio_path:
+        shutil.copy(audio_path, audio_save_path)
+
+    mp4_save_path = mp4_path if save_dir == mp4_path.parent else save_dir / f"{song_id}.mp4"
     if mp4_save_path != mp4_path:
         shutil.copy(mp4_path, mp4_save_path)
 
-    return {"mp3": mp3_save_path, "mp4": mp4_save_path}
+    return {
+        "audio": audio_save_path,
+        "mp4": mp4_save_path,
+        "duration": duration,
+        "input_hash": render_key,
+        "stages": report.records
+    }
 
 
 def visualize_playlist(
@@ -262,98 +890,184 @@ def visualize_playlist(
         xlsx_file: Path,
         bg_file: Path,
         save_dir: Path = Path.cwd(),
-        example_frame: bool = False
+        example_frame: bool = False,
+        workers: Optional[int] = None,
+        fetch_workers: int = 4,
+        queue_size: int = 2,
+        fetcher: Optional[Fetcher] = None,
+        build_id: Optional[str] = None,
+        profile: bool = False,
+        incremental: bool = True,
+        encoding: Optional[dict] = None,
+        executor: Optional[ProcessPoolExecutor] = None,
+        chunk_seconds: int = CHUNK_SECONDS
 ) -> dict[str, Path]:
-    """ Получить mp4 для всего плейлиста """
-
-    playlist = XLSXFile(xlsx_file).read()
-    playlist = [{k.lower(): v for k, v in song.items()} for song in playlist]
-    processed = []
+    """ Получить mp4 для всего плейлиста
+
+    Треки скачиваются (fetch_workers потоков), отрисовываются и кодируются
+    (workers процессов, по умолчанию по числу ядер) и склеиваются в общий звук
+    одновременно: между этапами очереди на queue_size треков.
+
+    Замеры этапов сохраняются в build_report.json рядом с playlist.mp4,
+    с profile=True туда же (в папку profiles) пишется профиль отрисовки кадров.
+
+    executor - готовый пул процессов для отрисовки (иначе создаётся на время сборки).
+    Трек длиннее двух chunk_seconds отрисовывается по частям в нескольких
+    процессах пула сразу, поэтому длинный трек не задерживает всю сборку.
+
+    С incremental=True план сборки из timeline.json рядом с playlist.mp4
+    сравнивается с новым: заново делаются только mp4 изменившихся строк,
+    микс собирается, только если изменился звук, а если не изменилось
+    ничего, playlist.mp4 не перезаписывается.
+    """
+
+    # Таблица (xlsx, csv или jsonl) читается построчно: первые треки уходят
+    # в работу, пока остальные строки ещё не прочитаны
+    playlist = get_table_file(xlsx_file).iter_rows()
+    playlist = ({k.lower(): v for k, v in song.items()} for song in playlist)
+    fetcher = fetcher or YouTubeFetcher()
+
+    songs = (
+        {
+            "url": song["url"],
+            "title": song["title"],
+            "crop_start": int(song.get("crop_start") or 0),
+            "crop_end": int(song.get("crop_end") or 0)
+        }
+        for song in playlist
+    )
 
     # Отдать пример кадра, если нужен только он
 
     if example_frame:
-        song = playlist[0]
-        url = song["url"]
-        title = song["title"]
-        crop_start = song.get("crop_start") or 0
-        crop_end = song.get("crop_end") or 0
+        song = next(songs)
         song_files = visualize_song(
             styles=styles,
-            url=url,
-            title=title,
             bg_file=bg_file,
-            crop_start=crop_start,
-            crop_end=crop_end,
             save_dir=save_dir,
-            example_frame=True
+            example_frame=True,
+            **song
         )
         jpg = song_files["jpg"]
         return {"jpg": jpg}
 
-    # Получить mp3 и mp4 для каждого трека
+    # Прочитанные строки запоминаются, чтобы назвать трек в сообщении об ошибке
+    started = []
+
+    def read_songs() -> Iterator[dict]:
+        for song in songs:
+            started.append(song)
+            yield song
+
+    # =============== #
+    # Этапы конвейера #
+    # =============== #
+
+    workers = workers or default_workers()
+    own_executor = executor is None
+    # Процессы пула запускаются до потоков конвейера (см. start_executor)
+    executor = executor or start_executor(workers)
+    report = BuildReport()
+
+    # Треки кодируются одновременно, поэтому "auto" делит ядра между ними
+    encoding = resolve_threads(encoding or get_encoding(), jobs=workers)
 
-    for song in playlist:
+    # Общий фон рисуется заранее, процессы отрисовки только читают его из кэша
+    with report.stage("background"):
+        get_base_layer(styles, bg_file, build_id=build_id)
 
-        url = song["url"]
-        title = song["title"]
-        crop_start = song.get("crop_start") or 0
-        crop_end = song.get("crop_end") or 0
+    def fetch(song: dict) -> dict:
+        audio_path = fetch_song(song["url"], dirs.cache, fetcher, build_id=build_id, report=report)
+        return {**song, "audio": audio_path}
 
-        song_files = run_as_process(
-            visualize_song,
+    def render(song: dict) -> dict:
+        # Трек (или его части) отрисовывается и кодируется в процессах пула,
+        # звук уже найден или скачан на этапе fetch
+        result = visualize_song(
             styles=styles,
-            url=url,
-            title=title,
             bg_file=bg_file,
-            crop_start=crop_start,
-            crop_end=crop_end,
             save_dir=dirs.cache,
-            silent=True
+            silent=True,
+            build_id=build_id,
+            profile_dir=save_dir / "profiles" if profile else None,
+            encoding=encoding,
+            executor=executor,
+            chunk_seconds=chunk_seconds,
+            **song
         )
+        report.extend(result.pop("stages"))
+        return {**song, **result}
 
-        mp4 = song_files["mp4"]
-        mp3 = song_files["mp3"]
+    stages = [
+        Stage("fetch", fetch, workers=fetch_workers),
+        Stage("render", render, workers=workers)
+    ]
 
-        processed.append((mp4, mp3, url, title, crop_start, crop_end))
+    # Объединить звук и mp4 в один файл (звук склеивается по мере готовности треков).
+    # Треки декодируются из исходного формата, кодируется только итоговый микс.
 
-    # Объединить mp3 и mp4 в один файл
-
-    mp4s = [data[0] for data in processed]
-    clips = [VideoFileClip(str(mp4)) for mp4 in mp4s]
-    video_clip = concatenate_videoclips(clips, method="compose")
-
-    audio = None
+    previous = Timeline.load(save_dir, mode=1) if incremental else None
+    timeline = Timeline(mode=1)
+    mp4s = []
     timecodes = []
     start_seconds = 0
 
-    for _, mp3, url, title, crop_start, crop_end in processed:
-
-        segment = AudioSegment.from_mp3(mp3)
-        duration = int(segment.duration_seconds) - crop_end - crop_start
-        segment = segment[(crop_start * 1000):((crop_start + duration) * 1000)]
-        if audio is None:
-            audio = segment
-        else:
-            audio = audio.append(segment, crossfade=100)
-        silence = AudioSegment.from_mp3(str(dirs.static / "silence22.mp3"))
-        silence = silence[:2200]
-        audio = audio.append(silence, crossfade=100)
-
-        timecode = strftime("%M:%S", gmtime(start_seconds))
-        timecodes.append(f"{timecode} {title} ({url})\n")
-        start_seconds += (duration + 2)
-
-    mp3_playlist = dirs.cache / "playlist.mp3"
-    audio.export(str(mp3_playlist), format="mp3")
-
-    audio_clip = AudioFileClip(str(mp3_playlist))
-    video_clip.audio = CompositeAudioClip([audio_clip])
+    # Тишина между треками декодируется один раз, микс пишется по ходу склейки
+    silence = AudioSegment.from_mp3(str(dirs.static / "silence22.mp3"))
+
+    try:
+        with MixBuilder(
+                dirs.cache,
+                silence,
+                previous=previous,
+                build_id=build_id,
+                report=report,
+                bitrate=encoding["audio_bitrate"]
+        ) as mix:
+            for song in run_pipeline(read_songs(), stages, queue_size=queue_size):
+
+                mix.append(song)
+                timeline.add(song, input_hash=song["input_hash"], segment=song["mp4"], start=start_seconds)
+
+                timecode = strftime("%M:%S", gmtime(start_seconds))
+                timecodes.append(f"{timecode} {song['title']} ({song['url']})\n")
+                start_seconds += (song["duration"] + 2)
+                mp4s.append(song["mp4"])
+
+            mp3_playlist = mix.close()
+            timeline.mix = mp3_playlist.name
+
+    except TaskError as e:
+        song = started[e.index]
+        raise Exception(f"Failed to render song #{e.index + 1} {song['title']!r} ({song['url']})") from e
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
+    # Треки закодированы с одинаковыми параметрами, поэтому склеиваются
+    # без перекодирования, а звук подставляется из готового микса
     mp4_playlist = save_dir / "playlist.mp4"
-    video_clip.write_videofile(str(mp4_playlist), threads=8, fps=1)
+    if not (timeline.same_output(previous) and mp4_playlist.exists()):
+        # План забывается, пока видео перезаписывается: прерванная склейка не сойдёт за готовую
+        Timeline.discard(save_dir)
+        with report.stage("concat") as record:
+            with atomic_write(mp4_playlist) as tmp_path:
+                concat_videos(mp4s, tmp_path, audio=mp3_playlist)
+            record["bytes_read"] = sum(file_size(mp4) for mp4 in mp4s) + file_size(mp3_playlist)
+            record["bytes_written"] = file_size(mp4_playlist)
+    timeline.save(save_dir)
 
     txt_timecodes = save_dir / "timecodes.txt"
     with open(txt_timecodes, "w", encoding="utf-8") as file:
         file.writelines(timecodes)
 
-    return {"mp4": mp4_playlist, "txt": txt_timecodes}
+    json_report = report.save(
+        save_dir,
+        mode=1,
+        songs=len(mp4s),
+        workers=workers,
+        fetch_workers=fetch_workers,
+        changed_rows=timeline.changed_rows(previous)
+    )
+
+    return {"mp4": mp4_playlist, "txt": txt_timecodes, "json": json_report}
@@ -2,14 +2,20 @@ from pathlib import Path
 from time import strftime, gmtime
 from typing import Optional
 
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-from moviepy.editor import AudioFileClip, ImageClip, CompositeAudioClip, concatenate_videoclips
+from PIL import Image, ImageDraw, ImageOps
 from pydub import AudioSegment
 
 import dirs
-from library.files import XLSXFile, Folder
-from library.utils import download_youtube_video, mp4_to_mp3
+from library.cache import atomic_write, get_index, hash_bytes, hash_data
+from library.fetch import Fetcher, YouTubeFetcher, fetch_song, get_song_id
+from library.encoding import get_encoding, get_encoding_key, resolve_threads
+from library.ffmpeg import concat_videos, encode_still
+from library.files import get_table_file
+from library.fonts import load_font
+from library.pipeline import Stage, run_pipeline
+from library.process import TaskError, default_workers
+from library.report import BuildReport, file_size
+from library.timeline import MixBuilder, Timeline
 
 
 def get_frame(
@@ -32,8 +38,7 @@ def get_frame(
     stroke_width = styles["v2"]["tracklist"]["stroke_width"]
     line_height = styles["v2"]["tracklist"]["line_height"]
 
-    font_path = str(dirs.fonts / font_name)
-    font = ImageFont.truetype(font_path, font_size)
+    font = load_font(dirs.fonts / font_name, font_size)
 
     for idx, title in enumerate(titles):
         x, y = tracklist_coords
@@ -45,19 +50,87 @@ def get_frame(
     return frame
 
 
+def get_segment_key(frame: Image, duration: int, encoding: dict) -> str:
+    """ Ключ кэша mp4 трека: хэш кадра, длительности и параметров кодирования """
+    return hash_data({
+        "frame": hash_bytes(frame.tobytes()),
+        "size": frame.size,
+        "duration": duration,
+        "encoding": get_encoding_key(encoding)
+    })
+
+
+def get_segment(
+        frame: Image,
+        duration: int,
+        key: Optional[str] = None,
+        build_id: Optional[str] = None,
+        report: Optional[BuildReport] = None,
+        encoding: Optional[dict] = None
+) -> Path:
+    """ Получить mp4 с неподвижным кадром трека (из кэша или закодировать) """
+
+    encoding = encoding or get_encoding()
+    key = key or get_segment_key(frame, duration, encoding)
+    mp4_name = f"v2_{key[:16]}.mp4"
+
+    index = get_index(dirs.cache)
+    report = report or BuildReport()
+
+    with report.stage("cache_lookup", segment=mp4_name) as record:
+        mp4_path = index.get(mp4_name, build_id=build_id)
+        record["hit"] = mp4_path is not None
+
+    if mp4_path is None:
+        # Одинаковый mp4, нужный нескольким сборкам сразу, кодируется один раз
+        with index.lock(mp4_name):
+            mp4_path = index.get(mp4_name, build_id=build_id, count=False)
+            if mp4_path is None:
+                with report.stage("encode", segment=mp4_name) as record:
+                    # Кадр кладётся во временную папку сборки, mp4 пишется через временный файл
+                    with index.scratch(build_id) as scratch, atomic_write(dirs.cache / mp4_name) as tmp_path:
+                        png_path = scratch / "frame.png"
+                        frame.save(str(png_path), format="PNG")
+                        encode_still(png_path, tmp_path, duration=duration, encoding=encoding)
+                    mp4_path = dirs.cache / mp4_name
+                    index.add(mp4_path, duration=duration, input_hash=key, build_id=build_id)
+                    record["bytes_written"] = file_size(mp4_path)
+
+    return mp4_path
+
+
 def visualize_playlist(
         styles: dict,
         xlsx_file: Path,
         img_file: Path,
         bg_file: Optional[Path] = None,
         save_dir: Path = Path.cwd(),
-        example_frame: bool = False
+        example_frame: bool = False,
+        workers: Optional[int] = None,
+        fetch_workers: int = 4,
+        queue_size: int = 2,
+        fetcher: Optional[Fetcher] = None,
+        build_id: Optional[str] = None,
+        incremental: bool = True,
+        encoding: Optional[dict] = None
 ) -> dict[str, Path]:
-    """ Получить mp4 для всего плейлиста """
+    """ Получить mp4 для всего плейлиста
+
+    Треки скачиваются (fetch_workers потоков), кодируются (workers потоков,
+    по умолчанию по числу ядер) и склеиваются в общий звук одновременно:
+    между этапами очереди на queue_size треков.
+
+    Замеры этапов сохраняются в build_report.json рядом с playlist.mp4.
 
-    playlist = XLSXFile(xlsx_file).read()
+    С incremental=True план сборки из timeline.json рядом с playlist.mp4
+    сравнивается с новым: микс собирается, только если изменился звук,
+    а если не изменилось ничего, playlist.mp4 не перезаписывается.
+    Трек-лист есть на каждом кадре, поэтому смена названия меняет mp4 всех треков.
+    """
+
+    # Трек-лист рисуется целиком на каждом кадре, поэтому таблица читается сразу вся
+    playlist = get_table_file(xlsx_file).read()
     playlist = [{k.lower(): v for k, v in song.items()} for song in playlist]
-    processed = []
 
     # ========================================= #
     # Фон, который не меняется от кадра к кадру #
@@ -99,80 +172,116 @@ def visualize_playlist(
         frame.save(str(save_path), format="JPEG", subsampling=0, quality=100)
         return {"jpg": save_path}
 
-    # =========== #
-    # Скачать mp3 #
-    # =========== #
-
-    for song in playlist:
-
-        url = song["url"]
-        title = song["title"]
-        crop_start = song.get("crop_start") or 0
-        crop_end = song.get("crop_end") or 0
-
-        song_id = url.replace("https://youtube.com/watch?v=", "")
-
-        # Ищем в ранее скачанных
-        mp3s = Folder(dirs.cache).find_by_name(f"{song_id}.mp3")
-        if mp3s:
-            mp3_path = mp3s[0]
-        else:
-            # Скачиваем видео, делаем аудио
-            mp4 = download_youtube_video(url, save_dir=dirs.cache, filename=f"{song_id}.mp4")
-            mp3_path = mp4_to_mp3(mp4, remove_src=True)
-
-        processed.append((mp3_path, url, title, crop_start, crop_end))
+    songs = [
+        {
+            "url": song["url"],
+            "title": song["title"],
+            "crop_start": int(song.get("crop_start") or 0),
+            "crop_end": int(song.get("crop_end") or 0)
+        }
+        for song in playlist
+    ]
+    titles = [song["title"] for song in songs]
+
+    # =============== #
+    # Этапы конвейера #
+    # =============== #
+
+    fetcher = fetcher or YouTubeFetcher()
+    workers = workers or default_workers()
+    report = BuildReport()
+
+    # Треки кодируются одновременно, поэтому "auto" делит ядра между ними
+    encoding = resolve_threads(encoding or get_encoding(), jobs=workers)
+
+    def fetch(song: dict) -> dict:
+        audio_path = fetch_song(song["url"], dirs.cache, fetcher, build_id=build_id, report=report)
+        return {**song, "audio": audio_path}
+
+    def render(song: dict) -> dict:
+        song_id = get_song_id(song["url"])
+
+        # Длительность берётся из заголовка файла (и запоминается в индексе кэша)
+        with report.stage("probe", song=song_id):
+            duration = int(get_index(dirs.cache).probe(song["audio"])["duration"]) - song["crop_end"] - song["crop_start"]
+
+        # Кадр трека кодируется один раз как неподвижное видео
+        with report.stage("frame_render", song=song_id, frames=1):
+            frame = get_frame(styles, bg_image, (tx, ty), titles=titles, current_title=song["title"])
+        key = get_segment_key(frame, duration + 2, encoding)
+        mp4_path = get_segment(frame, duration + 2, key=key, build_id=build_id, report=report, encoding=encoding)
+        return {**song, "mp4": mp4_path, "duration": duration, "input_hash": key}
+
+    stages = [
+        Stage("fetch", fetch, workers=fetch_workers),
+        Stage("render", render, workers=workers)
+    ]
 
     # =========== #
     # Сделать mp4 #
     # =========== #
 
-    titles = [data[2] for data in processed]
-
+    previous = Timeline.load(save_dir, mode=2) if incremental else None
+    timeline = Timeline(mode=2)
     video_clip_parts = []
 
-    audio = None
     timecodes = []
     start_seconds = 0
 
-    # Объединить mp3 и mp4 в один файл
-
-    for mp3_path, url, title, crop_start, crop_end in processed:
+    # Тишина между треками декодируется один раз, микс пишется по ходу склейки
+    silence = AudioSegment.from_mp3(str(dirs.static / "silence22.mp3"))
 
-        audio_clip = AudioFileClip(str(mp3_path))
-        duration = int(audio_clip.duration) - crop_end - crop_start
+    # Объединить звук и mp4 в один файл (звук склеивается по мере готовности треков).
+    # Треки декодируются из исходного формата, кодируется только итоговый микс.
 
-        frame = get_frame(styles, bg_image, (tx, ty), titles=titles, current_title=title)
-        clip = ImageClip(np.array(frame)).set_duration(duration + 2)
-        video_clip_parts.append(clip)
+    try:
+        with MixBuilder(
+                dirs.cache,
+                silence,
+                previous=previous,
+                build_id=build_id,
+                report=report,
+                bitrate=encoding["audio_bitrate"]
+        ) as mix:
+            for song in run_pipeline(songs, stages, queue_size=queue_size):
 
-        segment = AudioSegment.from_mp3(mp3_path)
-        duration = int(segment.duration_seconds) - crop_end - crop_start
-        segment = segment[(crop_start * 1000):((crop_start + duration) * 1000)]
-        if audio is None:
-            audio = segment
-        else:
-            audio = audio.append(segment, crossfade=100)
-        silence = AudioSegment.from_mp3(str(dirs.static / "silence22.mp3"))
-        silence = silence[:2200]
-        audio = audio.append(silence, crossfade=100)
+                video_clip_parts.append(song["mp4"])
+                mix.append(song)
+                timeline.add(song, input_hash=song["input_hash"], segment=song["mp4"], start=start_seconds)
 
-        timecode = strftime("%M:%S", gmtime(start_seconds))
-        timecodes.append(f"{timecode} {title} ({url})\n")
-        start_seconds += (duration + 2)
+                timecode = strftime("%M:%S", gmtime(start_seconds))
+                timecodes.append(f"{timecode} {song['title']} ({song['url']})\n")
+                start_seconds += (song["duration"] + 2)
 
-    mp3_playlist = dirs.cache / "playlist.mp3"
-    audio.export(str(mp3_playlist), format="mp3")
+            mp3_playlist = mix.close()
+            timeline.mix = mp3_playlist.name
 
-    video_clip = concatenate_videoclips(video_clip_parts, method="compose")
-    audio_clip = AudioFileClip(str(mp3_playlist))
-    video_clip.audio = CompositeAudioClip([audio_clip])
+    except TaskError as e:
+        song = songs[e.index]
+        raise Exception(f"Failed to render song #{e.index + 1} {song['title']!r} ({song['url']})") from e
 
     mp4_playlist = save_dir / "playlist.mp4"
-    video_clip.write_videofile(str(mp4_playlist), threads=8, fps=1)
+    if not (timeline.same_output(previous) and mp4_playlist.exists()):
+        # План забывается, пока видео перезаписывается: прерванная склейка не сойдёт за готовую
+        Timeline.discard(save_dir)
+        with report.stage("concat") as record:
+            with atomic_write(mp4_playlist) as tmp_path:
+                concat_videos(video_clip_parts, tmp_path, audio=mp3_playlist)
+            record["bytes_read"] = sum(file_size(mp4) for mp4 in video_clip_parts) + file_size(mp3_playlist)
+            record["bytes_written"] = file_size(mp4_playlist)
+    timeline.save(save_dir)
 
     txt_timecodes = save_dir / "timecodes.txt"
     with open(txt_timecodes, "w", encoding="utf-8") as file:
         file.writelines(timecodes)
 
-    return {"mp4": mp4_playlist, "txt": txt_timecodes}
+    json_report = report.save(
+        save_dir,
+        mode=2,
+        songs=len(video_clip_parts),
+        workers=workers,
+        fetch_workers=fetch_workers,
+        changed_rows=timeline.changed_rows(previous)
+    )
+
+    return {"mp4": mp4_playlist, "txt": txt_timecodes, "json": json_report}
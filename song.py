@@ -1,8 +1,12 @@
 from pathlib import Path
+from typing import Optional
 
-import numpy as np
-from PIL import Image, ImageFilter, ImageOps
-from moviepy.editor import AudioFileClip, ImageClip, CompositeAudioClip
+from PIL import Image, ImageOps
+
+import dirs
+from library.blur import gaussian_blur, get_blur_margin
+from library.cache import atomic_write, get_index
+from library.ffmpeg import encode_still
 
 
 def visualize_song(
@@ -10,9 +14,13 @@ def visualize_song(
         mp3_file: Path,
         img_file: Path,
         save_dir: Path = Path.cwd(),
-        example_frame: bool = False
+        example_frame: bool = False,
+        encoding: Optional[dict] = None
 ) -> dict:
-    """ Получить mp4 для одного трека или пример кадра """
+    """ Получить mp4 для одного трека или пример кадра
+
+    encoding - настройки кодирования (см. library.encoding).
+    """
 
     # ============================================================ #
     # Формирование единственного кадра (картинка на размытом фоне) #
@@ -29,13 +37,24 @@ def visualize_song(
     bg_image = img_image.copy()
     img_image = img_image.resize((ims, ims))
     bgs = int(w / ims) * w
-    bg_image = bg_image.resize((bgs, bgs))
-    bg_image = bg_image.filter(ImageFilter.GaussianBlur(radius=blur_radius))
 
     bg_rect_x = (bgs - w) // 2
     bg_rect_y = (bgs - h) // 2
     bg_rect = (bg_rect_x, bg_rect_y, bg_rect_x + w, bg_rect_y + h)
-    bg_image = bg_image.crop(bg_rect)
+
+    # Картинка растягивается до bgs x bgs, но увеличивается и размывается только
+    # середина кадра с полями под размытие (resize с box берёт те же точки исходника)
+    margin = get_blur_margin(blur_radius)
+    x0 = max(0, bg_rect[0] - margin)
+    y0 = max(0, bg_rect[1] - margin)
+    x1 = min(bgs, bg_rect[2] + margin)
+    y1 = min(bgs, bg_rect[3] + margin)
+    sx = bg_image.width / bgs
+    sy = bg_image.height / bgs
+    bg_image = bg_image.resize((x1 - x0, y1 - y0), box=(x0 * sx, y0 * sy, x1 * sx, y1 * sy))
+    bg_image = gaussian_blur(bg_image, blur_radius)
+
+    bg_image = bg_image.crop((bg_rect[0] - x0, bg_rect[1] - y0, bg_rect[2] - x0, bg_rect[3] - y0))
     bg_image = bg_image.resize((w, h))  # на всякий случай
 
     # Рамка картинки
@@ -60,10 +79,15 @@ def visualize_song(
     # Сделать mp4 #
     # =========== #
 
-    audio_clip = AudioFileClip(str(mp3_file))
-    video_clip = ImageClip(np.array(bg_image)).set_duration(audio_clip.duration)
-    video_clip.audio = CompositeAudioClip([audio_clip])
+    index = get_index(dirs.cache)
+    duration = index.probe(mp3_file)["duration"]
+
+    # Единственный кадр кодируется один раз, звук копируется без перекодирования.
+    # Кадр кладётся во временную папку, mp4 пишется через временный файл.
     mp4_song = save_dir / "song.mp4"
-    video_clip.write_videofile(str(mp4_song), threads=8, fps=1)
+    with index.scratch() as scratch, atomic_write(mp4_song) as tmp_path:
+        png_song = scratch / "song.png"
+        bg_image.save(str(png_song), format="PNG")
+        encode_still(png_song, tmp_path, duration=duration, audio=mp3_file, encoding=encoding)
 
     return {"mp4": mp4_song}